@@ -0,0 +1,151 @@
+"""
+Microbenchmark of query layer overhead: per-call time of the most frequent queries run the old way (statement
+built and compiled by SQLAlchemy on every call), with prebuilt statement compiled on every call and as prepared
+statement compiled once, against real Postgres.
+
+    DB_HOST=localhost DB_USER=bench DB_PASS=bench DB_DB=bench python -m benchmarks.bench_statements
+
+CPU time is of the bot process only, wall time includes Postgres parsing and planning.
+"""
+import argparse
+import asyncio
+import os
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+# settings required by the bot, but not used by benchmark
+os.environ.setdefault('BOT_TOKEN', '123456:' + 'x' * 35)
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('SENTRY_DSN', 'https://public@localhost/1')
+os.environ.setdefault('DB_HOST', 'localhost')
+os.environ.setdefault('DB_USER', 'bench')
+os.environ.setdefault('DB_PASS', 'bench')
+os.environ.setdefault('DB_DB', 'bench')
+
+import sqlalchemy as sa  # noqa: E402
+from aiopg.sa import SAConnection  # noqa: E402
+
+from oc_ref_bot import database  # noqa: E402
+from oc_ref_bot.database import tbl_refs, tbl_fsm, _refs_order_key  # noqa: E402
+from oc_ref_bot.search import like_pattern, similarity_text  # noqa: E402
+from oc_ref_bot.statements import Statement  # noqa: E402
+from benchmarks.bench_updates import FIRST_USER_ID, check_users  # noqa: E402
+
+# the same user as in `bench_updates`, benchmark doesn't run if he already exists
+USER_ID = FIRST_USER_ID
+
+Query = Callable[[SAConnection], Awaitable[Any]]
+
+
+# queries as they were built before statements were cached
+
+def _built_get_ref(ref_id: uuid.UUID) -> sa.sql.Select:
+    return sa.select(tbl_refs).where(tbl_refs.c.id == ref_id)
+
+
+def _built_get_refs(filter: str | None = None, after: dict | None = None) -> sa.sql.Select:
+    query = sa.select(tbl_refs).where(tbl_refs.c.user_id == USER_ID).limit(11)
+    if filter:
+        matched = tbl_refs.c.ref_name.ilike(like_pattern(filter), escape='\\')
+        text = similarity_text(filter)
+        query = (
+            query
+            .where(sa.or_(matched, tbl_refs.c.ref_name.op('%>')(text)))
+            .order_by(matched.desc(), sa.func.word_similarity(text, tbl_refs.c.ref_name).desc())
+        )
+    elif after:
+        query = query.where(sa.tuple_(*_refs_order_key) < sa.tuple_(after['score'], after['id']))
+    return query.order_by(*(column.desc() for column in _refs_order_key))
+
+
+def _built_get_fsm() -> sa.sql.Select:
+    return (
+        sa.select(tbl_fsm.c.state, tbl_fsm.c.data, tbl_fsm.c.version)
+        .where(sa.and_(tbl_fsm.c.chat_id == USER_ID, tbl_fsm.c.user_id == USER_ID))
+    )
+
+
+def cases(ref_id: uuid.UUID, after: dict) -> dict[str, tuple[Callable[[], sa.sql.Select], Statement, dict]]:
+    # name: (old query builder, prepared statement, its values)
+    return {
+        'get_ref': (lambda: _built_get_ref(ref_id), database._get_ref, {'ref_id': ref_id}),
+        'get_refs': (_built_get_refs, database._get_refs, {'user_id': USER_ID, 'limit': 11}),
+        'get_refs_after': (
+            lambda: _built_get_refs(after=after), database._get_refs_after,
+            {'user_id': USER_ID, 'limit': 11, 'after_score': after['score'], 'after_id': after['id']},
+        ),
+        'search_refs': (
+            lambda: _built_get_refs('Character 1'), database._search_refs,
+            {'user_id': USER_ID, 'limit': 11, 'pattern': like_pattern('Character 1'),
+             'text': similarity_text('Character 1')},
+        ),
+        'get_fsm': (_built_get_fsm, database._get_fsm, {'chat_id': USER_ID, 'user_id': USER_ID}),
+    }
+
+
+async def measure(conn: SAConnection, query: Query, calls: int) -> tuple[float, float]:
+    # returns wall and CPU time per call
+    for _ in range(min(calls, 100)):
+        await (await query(conn)).fetchall()
+    started_at, cpu_started_at = time.perf_counter(), time.process_time()
+    for _ in range(calls):
+        await (await query(conn)).fetchall()
+    return (time.perf_counter() - started_at) / calls, (time.process_time() - cpu_started_at) / calls
+
+
+async def cleanup(conn: SAConnection) -> None:
+    await conn.execute(sa.delete(tbl_fsm).where(tbl_fsm.c.user_id == USER_ID))
+    # refs are deleted by cascade
+    await conn.execute(sa.delete(database.tbl_users).where(database.tbl_users.c.id == USER_ID))
+
+
+async def prepare_data(conn: SAConnection, refs: int) -> None:
+    await cleanup(conn)
+    await conn.execute(sa.insert(database.tbl_users).values(id=USER_ID))
+    await database.add_refs(conn, USER_ID, [
+        {
+            'ref_name': f'Character {number}', 'doc_file_id': None, 'photo_file_id': f'photo{number}',
+            'doc_file_unique_id': None, 'photo_file_unique_id': f'photo{number}',
+        }
+        for number in range(refs)
+    ])
+    await database.save_fsm(conn, USER_ID, USER_ID, state='bench')
+
+
+async def main(args: argparse.Namespace) -> None:
+    async with database.db_engine() as pg, database.acquire(pg) as conn:
+        await database.ensure_schema(conn)
+        await check_users(conn, [USER_ID], delete_existing=args.delete_existing)
+        await prepare_data(conn, args.refs)
+        try:
+            refs = await database.get_refs(conn, USER_ID, None, limit=2)
+            after = {'score': refs[0].score, 'id': refs[0].id}
+            print(f'{"query":<15} {"path":<9} {"wall us":>9} {"cpu us":>9}')
+            for name, (build, statement, values) in cases(refs[0].id, after).items():
+                if args.queries and name not in args.queries:
+                    continue
+                paths: dict[str, Query] = {
+                    # what every call did before: building and compiling statement
+                    'built': lambda conn, build=build: conn.execute(build()),
+                    # prebuilt statement, still compiled by SQLAlchemy and parsed by Postgres every time
+                    'compiled': lambda conn, statement=statement, values=values: conn.execute(statement.query, values),
+                    'prepared': lambda conn, statement=statement, values=values: statement.execute(conn, **values),
+                }
+                for path, query in paths.items():
+                    wall, cpu = await measure(conn, query, args.calls)
+                    print(f'{name:<15} {path:<9} {wall * 1e6:>9.1f} {cpu * 1e6:>9.1f}')
+        finally:
+            await cleanup(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000, help='calls of every query on every path')
+    parser.add_argument('--refs', type=int, default=200, help='refs of the benchmark user')
+    parser.add_argument('--queries', nargs='*', help='queries to measure, all by default')
+    parser.add_argument(
+        '--delete-existing', action='store_true', help=f'delete data of user {USER_ID} left in the database',
+    )
+    asyncio.run(main(parser.parse_args()))
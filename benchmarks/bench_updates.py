@@ -0,0 +1,335 @@
+"""
+Load test of the bot: feeds synthetic updates into the dispatcher, with stubbed Bot API and real Postgres.
+
+    DB_HOST=localhost DB_USER=bench DB_PASS=bench DB_DB=bench python -m benchmarks.bench_updates
+
+Reports handler latency percentiles, DB queries per update and pool wait time for every scenario.
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import io
+import itertools
+import os
+import time
+from collections import Counter
+from collections.abc import AsyncGenerator
+from dataclasses import dataclass, field
+from typing import Any
+
+# settings required by the bot, but not used by benchmark
+os.environ.setdefault('BOT_TOKEN', '123456:' + 'x' * 35)
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('SENTRY_DSN', 'https://public@localhost/1')
+os.environ.setdefault('DB_HOST', 'localhost')
+os.environ.setdefault('DB_USER', 'bench')
+os.environ.setdefault('DB_PASS', 'bench')
+os.environ.setdefault('DB_DB', 'bench')
+
+import sqlalchemy as sa  # noqa: E402
+from aiogram import Bot, Dispatcher  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import GetMe, GetFile, SendPhoto, TelegramMethod  # noqa: E402
+from aiogram.types import Update, User, File, Message, Chat, PhotoSize  # noqa: E402
+from aiopg.sa import SAConnection  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from oc_ref_bot import database  # noqa: E402
+from oc_ref_bot.bot import create_dispatcher  # noqa: E402
+from oc_ref_bot.ref_cache import ref_cache, lookups as ref_cache_lookups  # noqa: E402
+
+# users ids of benchmark, data of these users only is deleted after benchmark. They may belong to real users,
+# so benchmark doesn't run if they already exist in the database
+FIRST_USER_ID = 2_000_000_000
+
+
+@dataclass
+class UpdateStats:
+    queries: int = 0
+    pool_wait: float = 0
+
+
+@dataclass
+class ScenarioStats:
+    latencies: list[float] = field(default_factory=list)
+    queries: list[int] = field(default_factory=list)
+    pool_waits: list[float] = field(default_factory=list)
+    errors: int = 0
+    duration: float = 0
+
+
+_current = contextvars.ContextVar[UpdateStats | None]('current_update_stats', default=None)
+
+
+def _instrument_db() -> None:
+    # counts queries and pool waiting time of the update being handled
+    execute = SAConnection.execute
+    acquire = database._acquire
+
+    def counting_execute(self: SAConnection, query: Any, *args: Any, **kwargs: Any) -> Any:
+        if stats := _current.get():
+            stats.queries += 1
+        return execute(self, query, *args, **kwargs)
+
+    async def timing_acquire(pg: Any, timeout: float | None = None) -> SAConnection:
+        started_at = time.perf_counter()
+        try:
+            return await acquire(pg, timeout)
+        finally:
+            if stats := _current.get():
+                stats.pool_wait += time.perf_counter() - started_at
+
+    SAConnection.execute = counting_execute
+    database._acquire = timing_acquire
+
+
+class StubSession(BaseSession):
+    # Answers all Bot API requests locally after `latency` seconds
+    def __init__(self, latency: float) -> None:
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._ids = itertools.count(1)
+        image = io.BytesIO()
+        Image.new('RGB', (1200, 900), 'white').save(image, 'PNG')
+        self._image = image.getvalue()
+
+    async def close(self) -> None:
+        pass
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[Any], timeout: int | None = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name='Bench')
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_path='documents/ref.png')
+        if method.__returning__ is Message:
+            message_id = next(self._ids)
+            photo = None
+            if isinstance(method, SendPhoto):
+                photo = [
+                    PhotoSize(file_id=f'photo{message_id}', file_unique_id=f'photo{message_id}', width=1, height=1),
+                ]
+            return Message(
+                message_id=message_id, date=datetime.datetime.now(), chat=Chat(id=method.chat_id, type='private'),
+                photo=photo,
+            )
+        return True
+
+    async def stream_content(
+            self, url: str, headers: dict[str, Any] | None = None, timeout: int = 30, chunk_size: int = 65536,
+            raise_for_status: bool = True,  # noqa: FBT001, FBT002 - signature of BaseSession
+    ) -> AsyncGenerator[bytes, None]:
+        await asyncio.sleep(self.latency)
+        for start in range(0, len(self._image), chunk_size):
+            yield self._image[start:start + chunk_size]
+
+
+class Driver:
+    def __init__(self, dp: Dispatcher, bot: Bot) -> None:
+        self.dp = dp
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict[str, Any]:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'Bench {user_id}', 'language_code': 'ru'}
+
+    def message(self, user_id: int, text: str | None = None, *, document: bool = False) -> dict[str, Any]:
+        message = {
+            'message_id': next(self._update_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        if document:
+            file_id = f'doc{next(self._file_ids)}'
+            message['document'] = {
+                'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'ref.png', 'file_size': 10_000,
+            }
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def inline_query(self, user_id: int, query: str, offset: str = '') -> dict[str, Any]:
+        update_id = next(self._update_ids)
+        return {
+            'update_id': update_id,
+            'inline_query': {
+                'id': str(update_id), 'from': self._user(user_id), 'query': query, 'offset': offset,
+                'chat_type': 'private',
+            },
+        }
+
+    def chosen_result(self, user_id: int, result_id: str) -> dict[str, Any]:
+        return {
+            'update_id': next(self._update_ids),
+            'chosen_inline_result': {'result_id': result_id, 'from': self._user(user_id), 'query': ''},
+        }
+
+    async def feed(self, stats: ScenarioStats, update: dict[str, Any]) -> Any:
+        update_stats = UpdateStats()
+        _current.set(update_stats)
+        started_at = time.perf_counter()
+        try:
+            result = await self.dp.feed_update(self.bot, Update.model_validate(update, context={'bot': self.bot}))
+            # same as polling does with methods returned by handlers
+            if isinstance(result, TelegramMethod):
+                await self.bot(result)
+        except Exception:
+            stats.errors += 1
+            return None
+        finally:
+            _current.set(None)
+        stats.latencies.append(time.perf_counter() - started_at)
+        stats.queries.append(update_stats.queries)
+        stats.pool_waits.append(update_stats.pool_wait)
+        return result
+
+
+async def scenario_add(driver: Driver, users: list[int], refs_per_user: int) -> ScenarioStats:
+    stats = ScenarioStats()
+
+    async def add_refs(user_id: int) -> None:
+        for number in range(refs_per_user):
+            await driver.feed(stats, driver.message(user_id, '/add'))
+            await driver.feed(stats, driver.message(user_id, f'Character {number} of {user_id}'))
+            await driver.feed(stats, driver.message(user_id, document=True))
+            await driver.feed(stats, driver.message(user_id, 'Сохранить'))
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(add_refs(user_id) for user_id in users))
+    stats.duration = time.perf_counter() - started_at
+    return stats
+
+
+async def scenario_inline(driver: Driver, users: list[int], queries: list[str], interval: float) -> ScenarioStats:
+    stats = ScenarioStats()
+
+    async def type_queries(user_id: int) -> None:
+        # keystrokes are not waiting for previous answers, same as Telegram does
+        tasks = []
+        for query in queries:
+            tasks.append(asyncio.create_task(driver.feed(stats, driver.inline_query(user_id, query))))
+            await asyncio.sleep(interval)
+        await asyncio.gather(*tasks)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(type_queries(user_id) for user_id in users))
+    stats.duration = time.perf_counter() - started_at
+    return stats
+
+
+async def scenario_chosen(driver: Driver, refs: list[tuple[int, str]], repeat: int) -> ScenarioStats:
+    stats = ScenarioStats()
+    updates = [driver.chosen_result(user_id, f'ph_{ref_id}') for user_id, ref_id in refs] * repeat
+    started_at = time.perf_counter()
+    await asyncio.gather(*(driver.feed(stats, update) for update in updates))
+    stats.duration = time.perf_counter() - started_at
+    return stats
+
+
+async def check_users(conn: SAConnection, users: list[int], *, delete_existing: bool) -> None:
+    # exits if any of benchmark users have data in the database, unless it's allowed to delete it
+    query = sa.union(
+        sa.select(database.tbl_users.c.id).where(database.tbl_users.c.id.in_(users)),
+        sa.select(database.tbl_fsm.c.user_id).where(database.tbl_fsm.c.user_id.in_(users)),
+    )
+    existing = [row[0] for row in await (await conn.execute(query)).fetchall()]
+    if existing and not delete_existing:
+        raise SystemExit(
+            f'Users {", ".join(map(str, sorted(existing)))} already exist in the database, they may be real users. '
+            'Run benchmark on a dedicated database, or pass --delete-existing if they were left by interrupted run',
+        )
+
+
+async def cleanup(pg: Any, users: list[int]) -> None:
+    async with database.acquire(pg) as conn:
+        await conn.execute(sa.delete(database.tbl_fsm).where(database.tbl_fsm.c.user_id.in_(users)))
+        # refs are deleted by cascade
+        await conn.execute(sa.delete(database.tbl_users).where(database.tbl_users.c.id.in_(users)))
+
+
+async def bench_refs(pg: Any, users: list[int]) -> list[tuple[int, str]]:
+    async with database.acquire(pg) as conn:
+        query = (
+            sa.select(database.tbl_refs.c.user_id, database.tbl_refs.c.id)
+            .where(database.tbl_refs.c.user_id.in_(users))
+        )
+        return [(row.user_id, str(row.id)) for row in await (await conn.execute(query)).fetchall()]
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def report(name: str, stats: ScenarioStats) -> None:
+    count = len(stats.latencies)
+    print(
+        f'{name:<10} {count:>7} {count / stats.duration if stats.duration else 0:>9.1f} '
+        f'{_percentile(stats.latencies, 50) * 1000:>8.1f} {_percentile(stats.latencies, 95) * 1000:>8.1f} '
+        f'{_percentile(stats.latencies, 99) * 1000:>8.1f} {sum(stats.queries) / max(count, 1):>9.2f} '
+        f'{_percentile(stats.pool_waits, 50) * 1000:>9.2f} {_percentile(stats.pool_waits, 99) * 1000:>9.2f} '
+        f'{stats.errors:>6}'
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    _instrument_db()
+    if args.no_cache:
+        ref_cache.max_users = 0
+    session = StubSession(args.api_latency / 1000)
+    bot = Bot(os.environ['BOT_TOKEN'], session=session)
+    users = [FIRST_USER_ID + number for number in range(args.users)]
+
+    async with create_dispatcher() as dp:
+        pg = dp.workflow_data['pg']
+        await dp.emit_startup(bot=bot, **dp.workflow_data)
+        async with database.acquire(pg) as conn:
+            await check_users(conn, users, delete_existing=args.delete_existing)
+        await cleanup(pg, users)
+        driver = Driver(dp, bot)
+        try:
+            results = {'add': await scenario_add(driver, users, args.refs)}
+            name = 'Character 1'
+            queries = [''] + [name[:length] for length in range(1, len(name) + 1)]
+            results['inline'] = await scenario_inline(driver, users, queries, args.keystroke_interval / 1000)
+            results['chosen'] = await scenario_chosen(driver, await bench_refs(pg, users), args.repeat)
+        finally:
+            # buffered writes must not get into DB after cleanup
+            await dp.workflow_data['users_buffer'].flush()
+            await dp.workflow_data['usage_buffer'].flush()
+            await cleanup(pg, users)
+            await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+
+    print(
+        f'{"scenario":<10} {"updates":>7} {"upd/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+        f'{"queries":>9} {"wait p50":>9} {"wait p99":>9} {"errors":>6}'
+    )
+    for name, stats in results.items():
+        report(name, stats)
+    print(f'Bot API calls: {dict(session.calls)}')
+    hits, misses = (ref_cache_lookups.values.get((('result', result),), 0) for result in ('hit', 'miss'))
+    print(f'Ref cache: {hits:.0f} hits, {misses:.0f} misses')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help='number of simulated users')
+    parser.add_argument('--refs', type=int, default=3, help='refs added by every user')
+    parser.add_argument('--repeat', type=int, default=5, help='times every ref is sent')
+    parser.add_argument('--api-latency', type=float, default=20, help='latency of stubbed Bot API, ms')
+    parser.add_argument('--keystroke-interval', type=float, default=50, help='interval between inline queries, ms')
+    parser.add_argument('--no-cache', action='store_true', help='disable refs cache for inline queries')
+    parser.add_argument(
+        '--delete-existing', action='store_true',
+        help=f'delete data of users with benchmark ids (from {FIRST_USER_ID}) left in the database',
+    )
+    asyncio.run(main(parser.parse_args()))
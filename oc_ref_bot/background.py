@@ -0,0 +1,118 @@
+import asyncio
+import contextlib
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any, Self
+
+from oc_ref_bot.metrics import Counter, Gauge
+
+log = logging.getLogger(__name__)
+
+queue_size = Gauge('ocrefbot_background_queue_size', 'Background jobs waiting in queue')
+jobs = Counter('ocrefbot_background_jobs_total', 'Background jobs by result')
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class BackgroundQueue:
+    # Bounded queue of fire-and-forget side effects (like messages to admin), so handlers neither wait for them
+    # nor fail because of them. New jobs are dropped when queue is full, they are not worth memory and delays.
+    # Jobs left on shutdown are done for at most `drain_timeout` seconds
+    def __init__(self, max_size: int, workers: int, drain_timeout: float) -> None:
+        self.drain_timeout = drain_timeout
+        self._queue: asyncio.Queue[tuple[str, Job]] = asyncio.Queue(max_size)
+        self._workers_count = workers
+        self._workers: list[asyncio.Task] = []
+        self._closed = False
+        queue_size.set_function(self._queue.qsize)
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def __aenter__(self) -> Self:
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self._workers_count)]
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self.drain()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def submit(self, name: str, job: Job) -> bool:
+        if self._closed:
+            jobs.inc(job=name, result='closed')
+            log.warning('Background job %s submitted after shutdown, dropped', name)
+            return False
+        try:
+            self._queue.put_nowait((name, job))
+        except asyncio.QueueFull:
+            jobs.inc(job=name, result='dropped')
+            log.warning('Background queue is full, job %s dropped', name)
+            return False
+        return True
+
+    async def drain(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            async with asyncio.timeout(self.drain_timeout):
+                await self._queue.join()
+        except TimeoutError:
+            log.warning('Background jobs were not done in %s s, %s more were waiting', self.drain_timeout,
+                        self._queue.qsize())
+
+    async def _work(self) -> None:
+        while True:
+            name, job = await self._queue.get()
+            try:
+                await job()
+                jobs.inc(job=name, result='done')
+            except Exception:
+                jobs.inc(job=name, result='failed')
+                log.exception('Background job %s failed', name)
+            finally:
+                self._queue.task_done()
+
+
+class Batcher:
+    # Collects items and submits them to background queue as one job every `interval` seconds
+    # or as soon as `max_size` items are collected. Items collected by shutdown are submitted by `flush()`
+    def __init__(
+            self, queue: BackgroundQueue, name: str, send: Callable[[list], Awaitable[Any]], interval: float,
+            max_size: int,
+    ) -> None:
+        self.queue = queue
+        self.name = name
+        self.send = send
+        self.interval = interval
+        self.max_size = max_size
+        self._items: list = []
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> Self:
+        self._task = asyncio.create_task(self._flush_loop())
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self.flush()
+
+    def add(self, item: Any) -> None:
+        self._items.append(item)
+        if len(self._items) >= self.max_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._items:
+            return
+        items, self._items = self._items, []
+        self.queue.submit(self.name, lambda: self.send(items))
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from typing import Self
+
+from aiopg.sa import Engine
+
+from oc_ref_bot.database import get_blocked_users, acquire
+
+log = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'ocrefbot_blocklist'
+
+
+class Blocklist:
+    # Blocked users are kept in memory, so updates from them are dropped without any query.
+    # Changes made by any bot instance come as notifications, whole list is reloaded after reconnecting
+    def __init__(self, pg: Engine) -> None:
+        self.pg = pg
+        self.users: set[int] = set()
+        self.loaded = False
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.users
+
+    async def load(self) -> None:
+        async with acquire(self.pg) as conn:
+            self.users = await get_blocked_users(conn)
+        self.loaded = True
+        log.info('Loaded %s blocked users', len(self.users))
+
+    async def _reload(self) -> None:
+        try:
+            await self.load()
+        except Exception:
+            log.exception('Loading blocked users failed')
+
+    def on_notify(self, payload: str) -> None:
+        action, user_id = payload.split(':')
+        if action == 'add':
+            self.users.add(int(user_id))
+        else:
+            self.users.discard(int(user_id))
+
+    def on_reconnect(self) -> None:
+        if not self.loaded:
+            # first loading is done on startup, after schema is created
+            return
+        if self._task is not None:
+            self._task.cancel()
+        self._task = asyncio.create_task(self._reload())
@@ -1,23 +1,83 @@
+import asyncio
+import contextlib
 import logging
-from collections.abc import Callable, Awaitable
+import time
+from collections.abc import Callable, Awaitable, AsyncIterator
 from typing import Any
 
 from aiogram import Dispatcher, Bot, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
 from aiogram.enums import ParseMode
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
 from aiogram.fsm.strategy import FSMStrategy
-from aiogram.types import BotCommand, User
+from aiogram.methods import TelegramMethod, Response
+from aiogram.types import User, TelegramObject, Update
 from aiogram.types import Message
 from aiopg.sa import Engine
 
-from oc_ref_bot import VERSION
-from oc_ref_bot.cmd_router import router as cmd_router
+from oc_ref_bot.cmd_router import router as cmd_router, forward_to_admin
 from oc_ref_bot.config import settings
-from oc_ref_bot.database import msg_from_user, create_tables, db_engine
+from oc_ref_bot.background import BackgroundQueue, Batcher
+from oc_ref_bot.blocklist import Blocklist, NOTIFY_CHANNEL as BLOCKLIST_NOTIFY_CHANNEL
+from oc_ref_bot.bulk import BulkCollector
+from oc_ref_bot.circuit_breaker import CircuitBreaker
+from oc_ref_bot.coalesce import InlineCoalescer
+from oc_ref_bot.converter import DocConverter
+from oc_ref_bot.database import ensure_schema, db_engine, replica_engine, UnitOfWork, acquire
+from oc_ref_bot.fsm_storage import PgStorage, NOTIFY_CHANNEL as FSM_NOTIFY_CHANNEL
 from oc_ref_bot.inline_router import router as inline_router
+from oc_ref_bot.metrics import Histogram, Counter, MetricsServer
+from oc_ref_bot.notifications import Listener
+from oc_ref_bot.rate_limit import RateLimitMiddleware
+from oc_ref_bot.ref_cache import RefsChanges, ref_cache, recent_writes, NOTIFY_CHANNEL as REFS_NOTIFY_CHANNEL
+from oc_ref_bot.replica import ReadRouter
+from oc_ref_bot.startup import phase, report, setup_bot
+from oc_ref_bot.webhook import start_webhook
+from oc_ref_bot.write_behind import UsersBuffer, UsageBuffer
 
 log = logging.getLogger(__name__)
 
+handler_seconds = Histogram('ocrefbot_handler_seconds', 'Handlers latency')
+handler_errors = Counter('ocrefbot_handler_errors_total', 'Exceptions raised by handlers')
+api_seconds = Histogram('ocrefbot_api_seconds', 'Telegram Bot API requests latency')
+api_errors = Counter('ocrefbot_api_errors_total', 'Failed Telegram Bot API requests')
+blocked_updates = Counter('ocrefbot_blocked_updates_total', 'Updates from blocked users dropped')
+
+
+class InlineFreeFSMMiddleware(BaseMiddleware):
+    # FSM middleware of aiogram, but inline queries get no FSM context. Their handler doesn't use it, and reading
+    # state wouldn't be limited by deadline of inline answer, nor guarded by DB breaker
+    def __init__(self, fsm: FSMContextMiddleware) -> None:
+        self.fsm = fsm
+
+    async def __call__(
+            self, handler: Callable[[Update, dict[str, Any]], Awaitable[Any]], event: Update, data: dict[str, Any],
+    ) -> Any:
+        if event.inline_query is not None:
+            return await handler(event, data)
+        return await self.fsm(handler, event, data)
+
+
+class BotDispatcher(Dispatcher):
+    # Updates from blocked users are dropped before any middleware, even before FSM middleware of aiogram reads
+    # state of the user, so they cost no DB round trip
+    def __init__(self, *, blocklist: Blocklist, **kwargs: Any) -> None:
+        super().__init__(blocklist=blocklist, disable_fsm=True, **kwargs)
+        self.blocklist = blocklist
+        # in place of FSM middleware disabled above
+        self.update.outer_middleware(InlineFreeFSMMiddleware(self.fsm))
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        user = UserContextMiddleware.resolve_event_context(update).user
+        if user is not None and user.id in self.blocklist and user.id != settings.admin_id:
+            blocked_updates.inc()
+            return None
+        return await super().feed_update(bot, update, **kwargs)
+
 
 class SavingUsersMiddleware(BaseMiddleware):
     def __init__(self) -> None:
@@ -26,48 +86,168 @@ class SavingUsersMiddleware(BaseMiddleware):
     async def __call__(
             self, handler: Callable[[Message, dict[str, Any]], Awaitable[Any]], event: Message, data: dict[str, Any]
     ) -> Any:
-        pg: Engine = data['pg']
+        users_buffer: UsersBuffer = data['users_buffer']
         user: User = data['event_context'].user
-        async with pg.acquire() as conn:
-            await msg_from_user(conn, user.id, user.username, user.first_name, user.last_name, user.is_premium,
-                                user.language_code)
+        users_buffer.add(user)
         return await handler(event, data)
 
 
-async def main_bot() -> None:
-    log.info('Starting bot...')
-    async with db_engine() as pg_engine:
-        dp = Dispatcher(fsm_strategy=FSMStrategy.USER_IN_CHAT, pg=pg_engine)
+class UnitOfWorkMiddleware(BaseMiddleware):
+    def __init__(self, storage: PgStorage, *, transaction: bool) -> None:
+        self.storage = storage
+        self.transaction = transaction
+
+    async def __call__(
+            self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], event: TelegramObject,
+            data: dict[str, Any],
+    ) -> Any:
+        db = UnitOfWork(data['pg'], transaction=self.transaction)
+        data['db'] = db
+        state: FSMContext | None = data.get('state')
+        if state is not None:
+            # handlers change states with the same connection (and transaction) they use for their queries
+            data['state'] = FSMContext(self.storage.bind(db), state.key)
+        success = False
+        try:
+            result = await handler(event, data)
+            success = True
+            return result
+        finally:
+            await db.close(success=success)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+            self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], event: TelegramObject,
+            data: dict[str, Any],
+    ) -> Any:
+        handler_object: HandlerObject = data['handler']
+        name = handler_object.callback.__name__
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started_at, handler=name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(
+            self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod,
+    ) -> Response:
+        name = method.__api_method__
+        started_at = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            api_errors.inc(method=name)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started_at, method=name)
+
+
+@contextlib.asynccontextmanager
+async def create_dispatcher() -> AsyncIterator[Dispatcher]:
+    async with (
+        db_engine() as pg_engine,
+        replica_engine(pg_engine) as replica_pg_engine,
+        UsersBuffer(pg_engine, settings.users_flush_size, settings.users_flush_interval) as users_buffer,
+        UsageBuffer(pg_engine, settings.usage_flush_size, settings.usage_flush_interval) as usage_buffer,
+        DocConverter(
+            settings.convert_workers, settings.convert_max_file_size, settings.convert_max_side,
+            settings.convert_max_pixels,
+        ) as converter,
+        PgStorage(
+            pg_engine, settings.fsm_cache_size, settings.fsm_state_ttl, settings.fsm_cleanup_interval,
+        ) as storage,
+        Blocklist(pg_engine) as blocklist,
+        Listener(pg_engine, {
+            FSM_NOTIFY_CHANNEL: storage, BLOCKLIST_NOTIFY_CHANNEL: blocklist,
+            REFS_NOTIFY_CHANNEL: RefsChanges(ref_cache, recent_writes),
+        }),
+        BackgroundQueue(
+            settings.background_queue_size, settings.background_workers, settings.background_drain_timeout,
+        ) as background,
+        Batcher(background, 'admin_digest', forward_to_admin, settings.admin_digest_interval, 100) as admin_digest,
+    ):
+        dp = BotDispatcher(
+            storage=storage, fsm_strategy=FSMStrategy.USER_IN_CHAT, pg=pg_engine, users_buffer=users_buffer,
+            usage_buffer=usage_buffer, converter=converter, bulk_collector=BulkCollector(settings.bulk_add_delay),
+            inline_coalescer=InlineCoalescer(), blocklist=blocklist,
+            db_breaker=CircuitBreaker('db', settings.db_breaker_failures, settings.db_breaker_reset_timeout),
+            background=background, admin_digest=admin_digest,
+            read_router=ReadRouter(pg_engine, replica_pg_engine, CircuitBreaker(
+                'replica', settings.db_breaker_failures, settings.db_breaker_reset_timeout,
+            )),
+        )
         log.info('Dispatcher created')
 
         @dp.startup()
         async def startup(pg, *args, **kwargs):
-            async with pg.acquire() as conn:
-                await create_tables(conn)
+            with phase('schema'):
+                async with acquire(pg) as conn:
+                    changed = await ensure_schema(conn)
+            log.info('Database schema was %s', 'updated' if changed else 'up to date')
+            with phase('blocklist'):
+                await blocklist.load()
 
+        @dp.shutdown()
+        async def shutdown(*args: Any, **kwargs: Any) -> None:
+            # before bot session is closed, so queued requests can still be sent
+            admin_digest.flush()
+            await background.drain()
+
+        dp.update.outer_middleware(UnitOfWorkMiddleware(storage, transaction=settings.db_transaction_per_update))
+        log.info('Unit of work middleware registered')
         dp.message.middleware(SavingUsersMiddleware())
         log.info('Saving users middleware registered')
-
-        bot = Bot(settings.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-        log.info('Bot initialized')
-
-        await bot.set_my_commands([
-            BotCommand(command='help', description='Справка по командам'),
-            # BotCommand(command='version', description='Текущая версия бота'),
-            BotCommand(command='add', description='Добавление референса'),
-            BotCommand(command='del', description='Удаление референса'),
-        ])
-        log.info('Bot command list updated')
-
-        me = await bot.get_me()
-        if me.full_name != f'{settings.bot_name} [{VERSION}]':
-            await bot.set_my_name(f'{settings.bot_name} [{VERSION}]')
-        log.info('Bot name was set')
+        for observer in (dp.message, dp.inline_query, dp.chosen_inline_result):
+            observer.middleware(HandlerMetricsMiddleware())
+        log.info('Handler metrics middleware registered')
 
         dp.include_router(cmd_router)
         log.info('Commands router registered')
         dp.include_router(inline_router)
         log.info('Inline router registered')
 
-        log.info('Starting polling')
-        await dp.start_polling(bot)
+        yield dp
+
+
+async def main_bot() -> None:
+    log.info('Starting bot...')
+    async with contextlib.AsyncExitStack() as stack:
+        with phase('dispatcher'):
+            dp = await stack.enter_async_context(create_dispatcher())
+        if settings.metrics_port:
+            await stack.enter_async_context(MetricsServer(settings.metrics_host, settings.metrics_port))
+        bot = Bot(settings.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        bot.session.middleware(RateLimitMiddleware(
+            settings.api_global_rate, settings.api_chat_rate, settings.api_chat_burst, settings.api_max_retries,
+            settings.api_max_retry_after,
+        ))
+        # after rate limiter, so every attempt is measured without waiting for it
+        bot.session.middleware(ApiMetricsMiddleware())
+        log.info('Bot initialized')
+
+        setup_task: asyncio.Task | None = None
+
+        @dp.startup()
+        async def setup_later(pg: Engine) -> None:
+            # runs after schema is ready, commands and name are not needed for answering updates,
+            # so they are set in background while updates are already being handled
+            nonlocal setup_task
+            setup_task = asyncio.create_task(setup_bot(bot, pg))
+            report()
+
+        try:
+            if settings.bot_mode == 'webhook':
+                log.info('Starting webhook')
+                await start_webhook(dp, bot)
+            else:
+                log.info('Starting polling')
+                await dp.start_polling(bot)
+        finally:
+            if setup_task is not None:
+                setup_task.cancel()
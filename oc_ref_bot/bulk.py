@@ -0,0 +1,21 @@
+import asyncio
+
+from aiogram.types import Message
+
+
+class BulkCollector:
+    # Collects files sent by user in bulk adding mode. Album and several files are delivered as separate updates,
+    # so batch is handled after `delay` seconds without new files from the user, by handler of its last message
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self._batches: dict[int, list[Message]] = {}
+
+    async def collect(self, user_id: int, message: Message) -> list[Message] | None:
+        # returns whole batch to handler of the last message, None to others
+        batch = self._batches.setdefault(user_id, [])
+        batch.append(message)
+        await asyncio.sleep(self.delay)
+        if batch[-1] is not message:
+            return None
+        del self._batches[user_id]
+        return sorted(batch, key=lambda item: item.message_id)
@@ -0,0 +1,82 @@
+import contextlib
+import logging
+import time
+from collections.abc import AsyncIterator
+
+from oc_ref_bot.metrics import Counter, Gauge
+
+log = logging.getLogger(__name__)
+
+breaker_state = Gauge('ocrefbot_circuit_breaker_open', 'Circuit breaker state: open 1, half-open 0.5, closed 0')
+breaker_transitions = Counter('ocrefbot_circuit_breaker_transitions_total', 'Circuit breaker state changes')
+breaker_rejected = Counter('ocrefbot_circuit_breaker_rejected_total', 'Calls rejected by open circuit breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 0.5, OPEN: 1}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Stops calls after `failure_threshold` failures in a row, so requests don't wait for something that is down
+    # and don't make it worse. After `reset_timeout` one trial call is let through, its success closes the breaker
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False
+        breaker_state.set(_STATE_VALUES[CLOSED], breaker=name)
+
+    def _set_state(self, state: str) -> None:
+        if state == self.state:
+            return
+        log.warning('Circuit breaker %s is %s', self.name, state)
+        self.state = state
+        breaker_state.set(_STATE_VALUES[state], breaker=self.name)
+        breaker_transitions.inc(breaker=self.name, state=state)
+
+    def allow(self) -> bool:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self._trial = False
+        self._set_state(CLOSED)
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._trial = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    @contextlib.asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        if not self.allow():
+            breaker_rejected.inc(breaker=self.name)
+            raise CircuitOpenError(self.name)
+        try:
+            yield
+        except Exception:
+            self.failure()
+            raise
+        except BaseException:
+            # cancelled trial call tells nothing, so another one is allowed
+            self._trial = False
+            raise
+        self.success()
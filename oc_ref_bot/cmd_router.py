@@ -1,23 +1,37 @@
+import asyncio
+import html
 import logging
-import os
-import uuid
-from pathlib import Path
+from pathlib import PurePath
 
 from aiogram import Router, F
-from aiogram.exceptions import TelegramBadRequest
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramAPIError
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, FSInputFile, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiopg.sa import Engine
 
+from oc_ref_bot.background import Batcher
+from oc_ref_bot.blocklist import Blocklist
+from oc_ref_bot.bulk import BulkCollector
 from oc_ref_bot.config import settings
-from oc_ref_bot.database import add_ref, RefAlreadyExistsError, del_ref
+from oc_ref_bot.converter import DocConverter, FileTooLargeError
+from oc_ref_bot.database import (
+    add_ref, add_refs, RefAlreadyExistsError, del_ref, UnitOfWork, get_refs_by_docs, get_user_ref_by_photo,
+    stream_user_refs, stream_table, tbl_users, tbl_refs, USER_REFS_EXPORT_COLUMNS, block_user, unblock_user,
+    get_blocklist,
+)
+from oc_ref_bot.export import csv_document
+from oc_ref_bot.write_behind import UsersBuffer
 
 router = Router()
 
 log = logging.getLogger(__name__)
 
+# limits of ref names, the same for all ways of adding refs
+REF_NAME_MAX_LENGTH = 128
+REF_NAME_MIN_LENGTH = 2
+
 
 class ChatState(StatesGroup):
     name_input = State()
@@ -25,6 +39,26 @@ class ChatState(StatesGroup):
     confirm_adding = State()
     del_ref = State()
     del_ref_confirm = State()
+    bulk_add = State()
+
+
+def _duplicate_warning(ref_name: str) -> str:
+    return f'Кстати, эта картинка у тебя уже сохранена под именем «{html.escape(ref_name)}» о:'
+
+
+async def forward_to_admin(messages: list[Message]) -> None:
+    # uploads digest for admin, one request per chat instead of one per message
+    chats: dict[int, list[Message]] = {}
+    for message in messages:
+        chats.setdefault(message.chat.id, []).append(message)
+    for chat_id, chat_messages in chats.items():
+        message_ids = sorted({message.message_id for message in chat_messages})
+        try:
+            for start in range(0, len(message_ids), 100):
+                await chat_messages[0].bot.forward_messages(settings.admin_id, chat_id, message_ids[start:start + 100])
+        except TelegramAPIError as e:
+            # messages may be deleted already, that's not a reason to skip other chats
+            log.warning('Forwarding messages from chat %s to admin failed: %s', chat_id, e)
 
 
 @router.message(Command('start'))
@@ -65,7 +99,10 @@ async def cmd_help(message: Message):
         'Или лезть в свой канал, искать там закреплённое сообщение и его пересылать. Про "избранное" я вообще молчу.. '
         'Скажу тебе по секрету, у него там такааая помойка из всяких файлов/записок/заметок, ууххх.. '
         'Ну воть, а я сделан для того чтоб помочь легко найти и достать свой реф uwu\n\n'
-        'Так же реф всегда можно удалить, для этого достаточно воспользоваться командой /del и выбрать, какой реф вы хотите удалить c:'
+        'Так же реф всегда можно удалить, для этого достаточно воспользоваться командой /del и выбрать, '
+        'какой реф вы хотите удалить c:\n\n'
+        'Если рефок много, их можно добавить все сразу командой /add_many\n\n'
+        'А выгрузить список всех своих рефок можно командой /csv (или /csv gzip, если их ну очень много)'
     )
     log.info('User %s asked for help', message.from_user.full_name)
 
@@ -82,10 +119,10 @@ async def cmd_add(message: Message, state: FSMContext):
 
 @router.message(ChatState.name_input, F.text)
 async def cmd_add_1(message: Message, state: FSMContext):
-    if len(message.text) > 128:
+    if len(message.text) > REF_NAME_MAX_LENGTH:
         await message.bot.send_message(message.chat.id, 'Слишком длинное имя, давай что-нибудь покороче о:')
         return
-    if len(message.text) < 2:
+    if len(message.text) < REF_NAME_MIN_LENGTH:
         await message.bot.send_message(message.chat.id, 'Слишком короткое имя, давай хотя бы пару букв о:')
         return
     await state.set_data({'name': message.text})
@@ -95,8 +132,12 @@ async def cmd_add_1(message: Message, state: FSMContext):
 
 
 @router.message(ChatState.add_ref, F.photo)
-async def cmd_add_2_photo(message: Message, state: FSMContext):
+async def cmd_add_2_photo(message: Message, state: FSMContext, db: UnitOfWork, admin_digest: Batcher):
     data = await state.get_data()
+    conn = await db.connection()
+    same_ref = await get_user_ref_by_photo(conn, message.from_user.id, message.photo[0].file_unique_id)
+    if same_ref:
+        await message.answer(_duplicate_warning(same_ref.ref_name))
     await message.bot.send_message(
         message.chat.id,
         'Нееет, рефку нужно отправить файлом, не фоткой :с\n'
@@ -107,28 +148,33 @@ async def cmd_add_2_photo(message: Message, state: FSMContext):
             one_time_keyboard=True,
         )
     )
-    photo_file_id = message.photo[0].file_id
-    data['photo_file_id'] = photo_file_id
+    data['photo_file_id'] = message.photo[0].file_id
+    data['photo_file_unique_id'] = message.photo[0].file_unique_id
     await state.set_data(data)
     log.info('User %s uploaded photo with ref', message.from_user.full_name)
 
     # for debug, remove later
-    await message.forward(settings.admin_id)
+    admin_digest.add(message)
 
 
 @router.message(ChatState.add_ref, F.text == 'Хочу сохранить в таком виде')
-async def cmd_add_2_confirm(message: Message, state: FSMContext, pg: Engine):
-    async with pg.acquire() as conn:
-        data = await state.get_data()
-        try:
-            await add_ref(conn, message.from_user.id, data['name'], data.get('doc_file_id'), data['photo_file_id'])
-        except RefAlreadyExistsError:
-            await message.answer('Рефка с таким названием уже добавлена! Укажи, пожалуйста, другое название')
-            await state.set_state(ChatState.name_input)
-            return
-        except Exception:
-            await message.answer('Что-то поломалось \>.\<')
-            raise
+async def cmd_add_2_confirm(message: Message, state: FSMContext, db: UnitOfWork, users_buffer: UsersBuffer):
+    conn = await db.connection()
+    # user must be saved before adding ref to him
+    await users_buffer.flush(message.from_user.id, conn=conn)
+    data = await state.get_data()
+    try:
+        await add_ref(conn, message.from_user.id, {
+            'ref_name': data['name'], 'doc_file_id': data.get('doc_file_id'), 'photo_file_id': data['photo_file_id'],
+            'doc_file_unique_id': None, 'photo_file_unique_id': data.get('photo_file_unique_id'),
+        })
+    except RefAlreadyExistsError:
+        await message.answer('Рефка с таким названием уже добавлена! Укажи, пожалуйста, другое название')
+        await state.set_state(ChatState.name_input)
+        return
+    except Exception:
+        await message.answer('Что-то поломалось \>.\<')
+        raise
     await message.bot.send_message(
         message.chat.id,
         'Хорошо, рефка добавлена, ближайшее время появится в inline-меню бота с:',
@@ -139,21 +185,40 @@ async def cmd_add_2_confirm(message: Message, state: FSMContext, pg: Engine):
 
 
 @router.message(ChatState.add_ref, F.document)
-async def cmd_add_2_doc(message: Message, state: FSMContext):
+async def cmd_add_2_doc(
+        message: Message, state: FSMContext, db: UnitOfWork, converter: DocConverter, admin_digest: Batcher,
+):
     data = await state.get_data()
-    path = Path(os.path.dirname(os.path.realpath(__file__))) / str(uuid.uuid4())
+    conn = await db.connection()
+    doc_file_unique_id = message.document.file_unique_id
+    same_ref = (await get_refs_by_docs(conn, message.from_user.id, [doc_file_unique_id])).get(doc_file_unique_id)
+    # not holding connection while file is converted
+    await db.release()
+    data.update({'doc_file_id': message.document.file_id, 'doc_file_unique_id': doc_file_unique_id})
     try:
-        await message.bot.download(message.document.file_id, destination=path)
-        msg_with_photo = await message.answer_photo(FSInputFile(path),
-                                                    caption='Конвертнул файл так же в фотку, для удобства с:')
-        doc_file_id = message.document.file_id
-        photo_file_id = msg_with_photo.photo[0].file_id
-        data.update({'doc_file_id': doc_file_id, 'photo_file_id': photo_file_id})
+        if same_ref:
+            # this file was converted already, no need to download and upload it again
+            data.update({
+                'photo_file_id': same_ref['photo_file_id'],
+                'photo_file_unique_id': same_ref['photo_file_unique_id'],
+            })
+            if same_ref['user_id'] == message.from_user.id:
+                await message.answer(_duplicate_warning(same_ref['ref_name']))
+        else:
+            photo = await converter.convert(message.bot, message.document)
+            msg_with_photo = await message.answer_photo(
+                photo, caption='Конвертнул файл так же в фотку, для удобства с:',
+            )
+            data.update({
+                'photo_file_id': msg_with_photo.photo[0].file_id,
+                'photo_file_unique_id': msg_with_photo.photo[0].file_unique_id,
+            })
+    except FileTooLargeError:
+        await message.answer('Файл слишком большой, попробуй уменьшить его размер :с')
+        return
     except TelegramBadRequest:
         await message.answer('Не удалось обработать запрос :\\<')
         return
-    finally:
-        os.remove(path)
     await state.set_data(data)
     await state.set_state(ChatState.confirm_adding)
     await message.bot.send_message(
@@ -167,22 +232,28 @@ async def cmd_add_2_doc(message: Message, state: FSMContext):
     log.info('User %s uploaded doc with ref', message.from_user.full_name)
 
     # for debug, remove later
-    await message.forward(settings.admin_id)
+    admin_digest.add(message)
 
 
 @router.message(ChatState.confirm_adding, F.text == 'Сохранить')
-async def cmd_add_3_confirm(message: Message, state: FSMContext, pg: Engine):
-    async with pg.acquire() as conn:
-        data = await state.get_data()
-        try:
-            await add_ref(conn, message.from_user.id, data['name'], data['doc_file_id'], data['photo_file_id'])
-        except RefAlreadyExistsError:
-            await message.answer('Рефка с таким названием уже добавлена! Укажи, пожалуйста, другое название')
-            await state.set_state(ChatState.name_input)
-            return
-        except Exception:
-            await message.answer('Что-то поломалось >.<')
-            raise
+async def cmd_add_3_confirm(message: Message, state: FSMContext, db: UnitOfWork, users_buffer: UsersBuffer):
+    conn = await db.connection()
+    # user must be saved before adding ref to him
+    await users_buffer.flush(message.from_user.id, conn=conn)
+    data = await state.get_data()
+    try:
+        await add_ref(conn, message.from_user.id, {
+            'ref_name': data['name'], 'doc_file_id': data['doc_file_id'], 'photo_file_id': data['photo_file_id'],
+            'doc_file_unique_id': data.get('doc_file_unique_id'),
+            'photo_file_unique_id': data.get('photo_file_unique_id'),
+        })
+    except RefAlreadyExistsError:
+        await message.answer('Рефка с таким названием уже добавлена! Укажи, пожалуйста, другое название')
+        await state.set_state(ChatState.name_input)
+        return
+    except Exception:
+        await message.answer('Что-то поломалось >.<')
+        raise
     await message.bot.send_message(
         message.chat.id,
         'Хорошо, рефка добавлена, ближайшее время появится в inline-меню бота с:',
@@ -192,6 +263,140 @@ async def cmd_add_3_confirm(message: Message, state: FSMContext, pg: Engine):
     log.info('User %s has successfully added ref', message.from_user.full_name)
 
 
+@router.message(Command('add_many'))
+async def cmd_add_many(message: Message, state: FSMContext) -> None:
+    await message.answer(
+        'Отправляй рефки файлами, можно сразу несколько или альбомом. '
+        'Имя для каждой рефки возьму из подписи к файлу, а если её нет - из названия файла\n\n'
+        'Когда закончишь, нажми "Готово"',
+        reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text='Готово')]], resize_keyboard=True),
+    )
+    await state.set_state(ChatState.bulk_add)
+    log.info('User %s adding refs in bulk', message.from_user.full_name)
+
+
+@router.message(ChatState.bulk_add, F.text == 'Готово')
+async def cmd_add_many_done(message: Message, state: FSMContext) -> None:
+    await message.answer('Готово ^-^', reply_markup=ReplyKeyboardRemove())
+    await state.clear()
+
+
+class _SkippedRefError(Exception):
+    pass
+
+
+def _bulk_ref_name(message: Message) -> str:
+    if message.caption:
+        return message.caption.strip()
+    if message.document and message.document.file_name:
+        return PurePath(message.document.file_name).stem
+    return ''
+
+
+async def _prepare_bulk_ref(message: Message, name: str, same_ref: dict | None, converter: DocConverter) -> dict:
+    if len(name) > REF_NAME_MAX_LENGTH:
+        raise _SkippedRefError('слишком длинное имя')
+    if not name:
+        raise _SkippedRefError('нет имени, подпиши файл')
+    if len(name) < REF_NAME_MIN_LENGTH:
+        raise _SkippedRefError('слишком короткое имя')
+    if message.photo:
+        return {
+            'ref_name': name, 'doc_file_id': None, 'photo_file_id': message.photo[0].file_id,
+            'doc_file_unique_id': None, 'photo_file_unique_id': message.photo[0].file_unique_id,
+        }
+    ref = {'ref_name': name, 'doc_file_id': message.document.file_id,
+           'doc_file_unique_id': message.document.file_unique_id}
+    if same_ref:
+        # this file was converted already
+        return {**ref, 'photo_file_id': same_ref['photo_file_id'],
+                'photo_file_unique_id': same_ref['photo_file_unique_id']}
+    try:
+        photo = await converter.convert(message.bot, message.document)
+        msg_with_photo = await message.answer_photo(photo, caption=html.escape(name))
+    except FileTooLargeError:
+        raise _SkippedRefError('файл слишком большой') from None
+    except TelegramBadRequest:
+        raise _SkippedRefError('не получилось сделать из файла фотку') from None
+    return {**ref, 'photo_file_id': msg_with_photo.photo[0].file_id,
+            'photo_file_unique_id': msg_with_photo.photo[0].file_unique_id}
+
+
+def _sort_bulk_refs(
+        user_id: int, names: list[str], same_refs: list[dict | None], results: list[dict | BaseException],
+) -> tuple[dict[str, dict], list[str], list[str], list[str]]:
+    # returns refs to add by their names, names repeated in the batch, skipped files and already saved images
+    refs: dict[str, dict] = {}
+    existing, skipped, duplicates = [], [], []
+    for name, same_ref, result in zip(names, same_refs, results, strict=True):
+        if same_ref and same_ref['user_id'] == user_id and same_ref['ref_name'] != name:
+            duplicates.append(f'{name} - уже есть как «{same_ref["ref_name"]}»')
+        if isinstance(result, _SkippedRefError):
+            skipped.append(f'{name or "файл без имени"}: {result}')
+        elif isinstance(result, BaseException):
+            log.error('Preparing ref %s failed', name, exc_info=result)
+            skipped.append(f'{name or "файл без имени"}: что-то поломалось')
+        elif name in refs:
+            existing.append(name)
+        else:
+            refs[name] = result
+    return refs, existing, skipped, duplicates
+
+
+def _bulk_report(added: int, existing: list[str], skipped: list[str], duplicates: list[str]) -> str:
+    lines = [f'Добавлено рефок: {added}']
+    if existing:
+        lines.append('\nУже есть рефки с такими именами:\n' + '\n'.join(html.escape(name) for name in existing))
+    if skipped:
+        lines.append('\nНе получилось добавить:\n' + '\n'.join(html.escape(line) for line in skipped))
+    if duplicates:
+        lines.append(
+            '\nЭти картинки у тебя уже были сохранены:\n' + '\n'.join(html.escape(line) for line in duplicates),
+        )
+    lines.append('\nМожешь отправить ещё или нажми "Готово"')
+    return '\n'.join(lines)
+
+
+@router.message(ChatState.bulk_add, F.document | F.photo)
+async def cmd_add_many_file(
+        message: Message, db: UnitOfWork, converter: DocConverter, users_buffer: UsersBuffer,
+        bulk_collector: BulkCollector,
+) -> None:
+    batch = await bulk_collector.collect(message.from_user.id, message)
+    if batch is None:
+        # will be added with the last file of the batch
+        return
+    user_id = message.from_user.id
+    names = [_bulk_ref_name(item) for item in batch]
+    conn = await db.connection()
+    same_docs = await get_refs_by_docs(conn, user_id, [item.document.file_unique_id for item in batch if item.document])
+    same_refs = [same_docs.get(item.document.file_unique_id) if item.document else None for item in batch]
+    await db.release()
+    # conversions are limited by converter, so they can be started all at once
+    results = await asyncio.gather(
+        *(
+            _prepare_bulk_ref(item, name, same_ref, converter)
+            for item, name, same_ref in zip(batch, names, same_refs, strict=True)
+        ),
+        return_exceptions=True,
+    )
+    refs, existing, skipped, duplicates = _sort_bulk_refs(user_id, names, same_refs, results)
+
+    added = set()
+    if refs:
+        conn = await db.connection()
+        # user must be saved before adding refs to him
+        await users_buffer.flush(user_id, conn=conn)
+        added = await add_refs(conn, user_id, list(refs.values()))
+        existing.extend(name for name in refs if name not in added)
+
+    await message.answer(_bulk_report(len(added), existing, skipped, duplicates))
+    log.info(
+        'User %s added %s refs in bulk, %s already exist, %s skipped',
+        message.from_user.full_name, len(added), len(existing), len(skipped),
+    )
+
+
 @router.message(F.text == 'Отменить')
 async def cmd_cancel(message: Message, state: FSMContext):
     log.info('User %s has canceled action', message.from_user.full_name)
@@ -214,17 +419,91 @@ async def cmd_del(message: Message, state: FSMContext):
 
 
 @router.message(ChatState.del_ref_confirm, F.text == 'Да, удалить')
-async def cmd_del_confirm(message: Message, state: FSMContext, pg: Engine):
-    async with pg.acquire() as conn:
-        data = await state.get_data()
-        try:
-            result = await del_ref(conn, message.from_user.id, data['ref_id'])
-            if result:
-                await message.answer('Рефка успешно удалена! ^-^', reply_markup=ReplyKeyboardRemove())
-            else:
-                await message.answer('Не получилось удалить рефку, кажется она уже удалена о_О', reply_markup=ReplyKeyboardRemove())
-        except Exception:
-            await message.answer('Что-то поломалось >.<')
-            raise
+async def cmd_del_confirm(message: Message, state: FSMContext, db: UnitOfWork):
+    conn = await db.connection()
+    data = await state.get_data()
+    try:
+        result = await del_ref(conn, message.from_user.id, data['ref_id'])
+        if result:
+            await message.answer('Рефка успешно удалена! ^-^', reply_markup=ReplyKeyboardRemove())
+        else:
+            await message.answer(
+                'Не получилось удалить рефку, кажется она уже удалена о_О', reply_markup=ReplyKeyboardRemove(),
+            )
+    except Exception:
+        await message.answer('Что-то поломалось >.<')
+        raise
     log.info('User %s has deleted ref %s', message.from_user.full_name, data['ref_id'])
-    await state.clear()
\ No newline at end of file
+    await state.clear()
+
+
+@router.message(Command('csv'))
+async def cmd_csv(message: Message, command: CommandObject, pg: Engine) -> None:
+    # export streams rows with its own connection, the update doesn't need one
+    async with csv_document(
+        'refs.csv', USER_REFS_EXPORT_COLUMNS, stream_user_refs(pg, message.from_user.id),
+        compress=command.args == 'gzip',
+    ) as (document, rows):
+        if not rows:
+            await message.answer('У тебя пока нет ни одной рефки, добавить её можно командой /add')
+            return
+        await message.answer_document(document, caption=f'Рефок: {rows}')
+    log.info('User %s exported %s refs', message.from_user.full_name, rows)
+
+
+@router.message(Command('dump_all'), F.from_user.id == settings.admin_id)
+async def cmd_dump_all(message: Message, command: CommandObject, pg: Engine) -> None:
+    for table in (tbl_users, tbl_refs):
+        async with csv_document(
+            f'{table.name}.csv', table.columns.keys(), stream_table(pg, table), compress=command.args == 'gzip',
+        ) as (document, rows):
+            await message.answer_document(document, caption=f'{table.name}: {rows}')
+        log.info('Admin dumped %s rows of %s', rows, table.name)
+
+
+def _parse_user_id(command: CommandObject) -> tuple[int | None, str | None]:
+    # returns user id and the rest of arguments
+    user_id, *rest = (command.args or '').split(maxsplit=1) or ['']
+    if not user_id.lstrip('-').isdigit():
+        return None, None
+    return int(user_id), rest[0] if rest else None
+
+
+@router.message(Command('block'), F.from_user.id == settings.admin_id)
+async def cmd_block(message: Message, command: CommandObject, db: UnitOfWork, blocklist: Blocklist) -> None:
+    user_id, reason = _parse_user_id(command)
+    if user_id is None:
+        await message.answer('Использование: /block &lt;user_id&gt; [причина]')
+        return
+    blocked = await block_user(await db.connection(), user_id, reason)
+    # other instances get it by notification
+    blocklist.users.add(user_id)
+    await message.answer(
+        f'Пользователь {user_id} заблокирован' if blocked else f'Пользователь {user_id} уже в блоклисте',
+    )
+    log.info('Admin blocked user %s: %s', user_id, reason)
+
+
+@router.message(Command('unblock'), F.from_user.id == settings.admin_id)
+async def cmd_unblock(message: Message, command: CommandObject, db: UnitOfWork, blocklist: Blocklist) -> None:
+    user_id, _ = _parse_user_id(command)
+    if user_id is None:
+        await message.answer('Использование: /unblock &lt;user_id&gt;')
+        return
+    unblocked = await unblock_user(await db.connection(), user_id)
+    blocklist.users.discard(user_id)
+    await message.answer(
+        f'Пользователь {user_id} разблокирован' if unblocked else f'Пользователя {user_id} нет в блоклисте',
+    )
+    log.info('Admin unblocked user %s', user_id)
+
+
+@router.message(Command('blocklist'), F.from_user.id == settings.admin_id)
+async def cmd_blocklist(message: Message, db: UnitOfWork, blocklist: Blocklist) -> None:
+    rows = await get_blocklist(await db.connection(), limit=50)
+    lines = [f'Заблокировано: {len(blocklist.users)}']
+    lines.extend(
+        f'{row.user_id} ({row.created_at:%Y-%m-%d})' + (f': {html.escape(row.reason)}' if row.reason else '')
+        for row in rows
+    )
+    await message.answer('\n'.join(lines))
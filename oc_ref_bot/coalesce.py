@@ -0,0 +1,45 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+from oc_ref_bot.metrics import Counter
+
+dropped_queries = Counter('ocrefbot_inline_queries_dropped_total', 'Inline queries superseded by newer ones')
+shared_lookups = Counter('ocrefbot_shared_lookups_total', 'Lookups joined to the same lookup in progress')
+
+
+class InlineCoalescer:
+    # Telegram sends inline query on every keystroke, but user sees answer to the latest one only.
+    # Answers to superseded queries are dropped and identical lookups in progress are shared
+    def __init__(self) -> None:
+        self._latest: dict[int, str] = {}
+        self._lookups: dict[Hashable, asyncio.Task] = {}
+
+    def arrived(self, user_id: int, query_id: str) -> None:
+        self._latest[user_id] = query_id
+
+    def superseded(self, user_id: int, query_id: str) -> bool:
+        if self._latest.get(user_id) == query_id:
+            return False
+        dropped_queries.inc()
+        return True
+
+    def done(self, user_id: int, query_id: str) -> None:
+        if self._latest.get(user_id) == query_id:
+            del self._latest[user_id]
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        self._lookups.pop(key, None)
+        # all waiters may have stopped waiting already, error was handled by them then
+        if not task.cancelled():
+            task.exception()
+
+    async def share(self, key: Hashable, lookup: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._lookups.get(key)
+        if task is None:
+            task = self._lookups[key] = asyncio.ensure_future(lookup())
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            shared_lookups.inc()
+        # one waiter cancelled must not cancel lookup for others
+        return await asyncio.shield(task)
@@ -1,4 +1,6 @@
-from pydantic import Field, HttpUrl
+from typing import Any, Literal, Self
+
+from pydantic import Field, HttpUrl, field_validator, model_validator
 from pydantic_settings import BaseSettings
 
 
@@ -7,10 +9,71 @@ class Settings(BaseSettings):
     bot_name: str = Field(default='OC Reference Bot')
     admin_id: int = Field()
     sentry_dsn: HttpUrl = Field()
+    sentry_traces_sample_rate: float = Field(default=0.01, ge=0, le=1)
+    sentry_profiles_sample_rate: float = Field(default=0, ge=0, le=1)
+    sentry_error_traces_sample_rate: float = Field(default=0.5, ge=0, le=1)
+    sentry_error_boost_duration: float = Field(default=5 * 60)
     db_user: str
     db_pass: str
     db_host: str
+    db_port: int = Field(default=5432)
     db_db: str
+    db_pool_min_size: int = Field(default=1)
+    db_pool_max_size: int = Field(default=10)
+    db_acquire_timeout: float = Field(default=10)
+    db_transaction_per_update: bool = Field(default=False)
+    db_replica_host: str | None = Field(default=None)
+    db_replica_port: int | None = Field(default=None)
+    db_read_your_writes_window: float = Field(default=10)
+    db_breaker_failures: int = Field(default=5)
+    db_breaker_reset_timeout: float = Field(default=30)
+    bot_mode: Literal['polling', 'webhook'] = Field(default='polling')
+    webhook_url: HttpUrl | None = Field(default=None)
+    webhook_path: str = Field(default='/webhook')
+    webhook_host: str = Field(default='0.0.0.0')
+    webhook_port: int = Field(default=8080)
+    webhook_secret: str | None = Field(default=None, pattern=r'^[A-Za-z0-9_-]{1,256}$')
+    ref_cache_size: int = Field(default=1024)
+    ref_cache_max_refs: int = Field(default=200)
+    ref_cache_ttl: float = Field(default=600)
+    inline_deadline: float = Field(default=2.5)
+    inline_stale_cache_time: int = Field(default=5)
+    users_flush_size: int = Field(default=100)
+    users_flush_interval: float = Field(default=5)
+    usage_flush_size: int = Field(default=500)
+    usage_flush_interval: float = Field(default=30)
+    convert_workers: int = Field(default=2)
+    convert_max_file_size: int = Field(default=20 * 1024 * 1024)
+    convert_max_side: int = Field(default=2560)
+    convert_max_pixels: int = Field(default=16_000_000)
+    bulk_add_delay: float = Field(default=1)
+    fsm_cache_size: int = Field(default=1024)
+    fsm_state_ttl: float = Field(default=24 * 60 * 60)
+    fsm_cleanup_interval: float = Field(default=60 * 60)
+    api_global_rate: float = Field(default=30)
+    api_chat_rate: float = Field(default=1)
+    api_chat_burst: float = Field(default=3)
+    api_max_retries: int = Field(default=3)
+    api_max_retry_after: float = Field(default=60)
+    background_queue_size: int = Field(default=1000)
+    background_workers: int = Field(default=2)
+    background_drain_timeout: float = Field(default=10)
+    admin_digest_interval: float = Field(default=60)
+    metrics_host: str = Field(default='0.0.0.0')
+    metrics_port: int | None = Field(default=9090)
+
+    @field_validator('metrics_port', mode='before')
+    @classmethod
+    def empty_metrics_port(cls, value: Any) -> Any:
+        # empty METRICS_PORT disables metrics
+        return None if value == '' else value
+
+    @model_validator(mode='after')
+    def check_webhook_secret(self) -> Self:
+        # webhook server must not accept updates from anyone but Telegram
+        if self.bot_mode == 'webhook' and not self.webhook_secret:
+            raise ValueError('WEBHOOK_SECRET is required in webhook mode')
+        return self
 
 
 settings = Settings()
@@ -0,0 +1,76 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Self
+
+from aiogram import Bot
+from aiogram.types import Document, BufferedInputFile
+from PIL import Image, UnidentifiedImageError
+
+from oc_ref_bot.metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+conversion_seconds = Histogram('ocrefbot_conversion_seconds', 'Document to photo conversion latency')
+
+# Bot API limit for photos
+MAX_PHOTO_SIZE = 10 * 1024 * 1024
+
+
+class FileTooLargeError(Exception):
+    pass
+
+
+def _downscale(buffer: io.BytesIO, max_side: int, max_pixels: int) -> bytes:
+    # image is decoded right from download buffer, its data is copied only if it's returned as is
+    try:
+        image = Image.open(buffer)
+    except UnidentifiedImageError:
+        # not an image, let Telegram decide what to do with it
+        return buffer.getvalue()
+    except Image.DecompressionBombError:
+        raise FileTooLargeError from None
+    width, height = image.size
+    if width * height > max_pixels:
+        raise FileTooLargeError
+    if max(width, height) <= max_side and len(buffer.getbuffer()) <= MAX_PHOTO_SIZE:
+        return buffer.getvalue()
+    # decodes JPEG right in reduced size, so full size image is never kept in memory
+    image.draft('RGB', (max_side, max_side))
+    image.thumbnail((max_side, max_side))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    result = io.BytesIO()
+    image.save(result, 'JPEG', quality=90)
+    return result.getvalue()
+
+
+class DocConverter:
+    # Converts documents to photos in memory. Number of conversions at once is limited by `workers`,
+    # so memory usage is limited by `workers * max_file_size` plus decoded images of `max_pixels`
+    def __init__(self, workers: int, max_file_size: int, max_side: int, max_pixels: int) -> None:
+        self.max_file_size = max_file_size
+        self.max_side = max_side
+        self.max_pixels = max_pixels
+        self._semaphore = asyncio.Semaphore(workers)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='converter')
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        # running conversions are waited for in another thread, so event loop keeps serving other shutdown steps
+        await asyncio.to_thread(self._executor.shutdown, cancel_futures=True)
+
+    async def convert(self, bot: Bot, document: Document) -> BufferedInputFile:
+        if document.file_size and document.file_size > self.max_file_size:
+            raise FileTooLargeError
+        async with self._semaphore:
+            with conversion_seconds.time():
+                buffer = await bot.download(document.file_id)
+                data = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, _downscale, buffer, self.max_side, self.max_pixels,
+                )
+        log.debug('Document %s converted to photo (%s bytes)', document.file_unique_id, len(data))
+        return BufferedInputFile(data, filename=document.file_name or 'ref.jpg')
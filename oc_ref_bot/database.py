@@ -1,13 +1,39 @@
 import asyncio
 import contextlib
+import functools
+import hashlib
+import math
+import time
 import uuid
+from collections.abc import AsyncIterator, Callable, Awaitable
+from typing import Any
 
+import aiopg
 import psycopg2
 import sqlalchemy as sa
-from aiopg.sa import create_engine, SAConnection
-from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
+from aiopg.sa import create_engine, Engine, SAConnection
+from aiopg.sa.result import RowProxy
+from sqlalchemy.dialects.postgresql import UUID, JSONB, insert as pg_insert
 
 from oc_ref_bot.config import settings
+from oc_ref_bot.metrics import Histogram, Counter, Gauge
+from oc_ref_bot.ref_cache import ref_cache, recent_writes, CachedRefs
+from oc_ref_bot.search import like_pattern, similarity_text, PAGE_SIZE, FRECENCY_RATE, frecency_point
+from oc_ref_bot.statements import Statement
+
+pool_wait_seconds = Histogram('ocrefbot_db_pool_wait_seconds', 'Time spent waiting for a connection from pool')
+pool_timeouts = Counter('ocrefbot_db_pool_timeouts_total', 'Connection acquiring timeouts')
+pool_connections = Gauge('ocrefbot_db_pool_connections', 'Connections in pool by state')
+query_seconds = Histogram('ocrefbot_db_query_seconds', 'Database functions latency')
+
+
+def _timed(function: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs) -> Any:
+        with query_seconds.time(function=function.__name__):
+            return await function(*args, **kwargs)
+    return wrapper
+
 
 metadata = sa.MetaData()
 
@@ -35,53 +61,231 @@ tbl_refs = sa.Table(
     sa.Column("created_at", sa.DATETIME, default=sa.func.now(), nullable=False),
     sa.Column("used_at", sa.DATETIME, default=None),
     sa.Column("used_count", sa.INTEGER, default=0, nullable=False),
+    sa.Column("doc_file_unique_id", sa.TEXT),
+    sa.Column("photo_file_unique_id", sa.TEXT),
+    sa.Column("score", sa.FLOAT, nullable=False),
+)
+
+tbl_fsm = sa.Table(
+    "ocrefbot_fsm",
+    metadata,
+    sa.Column("chat_id", sa.BIGINT, primary_key=True),
+    sa.Column("user_id", sa.BIGINT, primary_key=True),
+    sa.Column("state", sa.TEXT),
+    sa.Column("data", JSONB, nullable=False),
+    sa.Column("version", sa.BIGINT, nullable=False),
+    sa.Column("updated_at", sa.DATETIME, default=sa.func.now(), nullable=False),
+)
+
+tbl_blocklist = sa.Table(
+    "ocrefbot_blocklist",
+    metadata,
+    sa.Column("user_id", sa.BIGINT, primary_key=True),
+    sa.Column("reason", sa.TEXT),
+    sa.Column("created_at", sa.DATETIME, default=sa.func.now(), nullable=False),
+)
+
+tbl_meta = sa.Table(
+    "ocrefbot_meta",
+    metadata,
+    sa.Column("key", sa.TEXT, primary_key=True),
+    sa.Column("value", sa.TEXT, nullable=False),
+)
+
+_fsm_next_version = sa.func.nextval('ocrefbot_fsm_version')
+
+# order of listing refs (by frecency, see `search.py`), covered by ocrefbot_refs_user_score_idx
+_refs_order_key = (tbl_refs.c.score, tbl_refs.c.id)
+
+
+# statements creating schema, their fingerprint is stored in ocrefbot_meta, so unchanged schema is not touched on start
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS ocrefbot_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS ocrefbot_users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        is_premium BOOL,
+        language_code TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT now(),
+        messages_count INTEGER NOT NULL DEFAULT 0
+    )""",
+    'CREATE EXTENSION IF NOT EXISTS "uuid-ossp";',
+    """CREATE TABLE IF NOT EXISTS ocrefbot_refs (
+        id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+        user_id INTEGER NOT NULL REFERENCES ocrefbot_users(id) ON DELETE CASCADE,
+        ref_name TEXT NOT NULL,
+        doc_file_id TEXT,
+        photo_file_id TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT now(),
+        used_at TIMESTAMP DEFAULT NULL,
+        used_count INTEGER NOT NULL DEFAULT 0,
+        UNIQUE(user_id, ref_name)
+    )""",
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm;',
+    'CREATE INDEX IF NOT EXISTS ocrefbot_refs_ref_name_trgm_idx ON ocrefbot_refs USING gin (ref_name gin_trgm_ops)',
+    'ALTER TABLE ocrefbot_refs ADD COLUMN IF NOT EXISTS score DOUBLE PRECISION',
+    # existing refs get score as if all their uses were at last use
+    f"""UPDATE ocrefbot_refs
+    SET score = extract(epoch FROM coalesce(used_at, created_at)) * {FRECENCY_RATE!r} + ln(greatest(used_count, 1))
+    WHERE score IS NULL""",
+    f"""ALTER TABLE ocrefbot_refs
+    ALTER COLUMN score SET DEFAULT extract(epoch FROM now()) * {FRECENCY_RATE!r},
+    ALTER COLUMN score SET NOT NULL""",
+    'DROP INDEX IF EXISTS ocrefbot_refs_user_order_idx',
+    'CREATE INDEX IF NOT EXISTS ocrefbot_refs_user_score_idx ON ocrefbot_refs (user_id, score DESC, id DESC)',
+    'ALTER TABLE ocrefbot_refs ADD COLUMN IF NOT EXISTS doc_file_unique_id TEXT',
+    'ALTER TABLE ocrefbot_refs ADD COLUMN IF NOT EXISTS photo_file_unique_id TEXT',
+    # converted photos of documents and duplicates detection
+    """CREATE INDEX IF NOT EXISTS ocrefbot_refs_doc_file_unique_id_idx ON ocrefbot_refs (doc_file_unique_id)
+    WHERE doc_file_unique_id IS NOT NULL""",
+    """CREATE INDEX IF NOT EXISTS ocrefbot_refs_photo_file_unique_id_idx
+    ON ocrefbot_refs (user_id, photo_file_unique_id) WHERE photo_file_unique_id IS NOT NULL""",
+    'CREATE SEQUENCE IF NOT EXISTS ocrefbot_fsm_version',
+    """CREATE TABLE IF NOT EXISTS ocrefbot_fsm (
+        chat_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        state TEXT,
+        data JSONB NOT NULL DEFAULT '{}',
+        version BIGINT NOT NULL DEFAULT nextval('ocrefbot_fsm_version'),
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (chat_id, user_id)
+    )""",
+    # notifies all bot instances about changed states, so they can drop it from their caches
+    """CREATE OR REPLACE FUNCTION ocrefbot_fsm_notify() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify(
+                'ocrefbot_fsm', OLD.chat_id || ':' || OLD.user_id || ':' || nextval('ocrefbot_fsm_version')
+            );
+        ELSE
+            PERFORM pg_notify('ocrefbot_fsm', NEW.chat_id || ':' || NEW.user_id || ':' || NEW.version);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS ocrefbot_fsm_notify ON ocrefbot_fsm',
+    """CREATE TRIGGER ocrefbot_fsm_notify AFTER INSERT OR UPDATE OR DELETE ON ocrefbot_fsm
+    FOR EACH ROW EXECUTE FUNCTION ocrefbot_fsm_notify()""",
+    # all bot instances drop cached refs of the user. Usage of refs isn't notified, it changes on every sent ref
+    """CREATE OR REPLACE FUNCTION ocrefbot_refs_notify() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('ocrefbot_refs', OLD.user_id::text);
+        ELSE
+            PERFORM pg_notify('ocrefbot_refs', NEW.user_id::text);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS ocrefbot_refs_notify ON ocrefbot_refs',
+    """CREATE TRIGGER ocrefbot_refs_notify
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, ref_name, doc_file_id, photo_file_id ON ocrefbot_refs
+    FOR EACH ROW EXECUTE FUNCTION ocrefbot_refs_notify()""",
+    """CREATE TABLE IF NOT EXISTS ocrefbot_blocklist (
+        user_id BIGINT PRIMARY KEY,
+        reason TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT now()
+    )""",
+    # every bot instance keeps blocked users in memory
+    """CREATE OR REPLACE FUNCTION ocrefbot_blocklist_notify() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('ocrefbot_blocklist', 'del:' || OLD.user_id);
+        ELSE
+            PERFORM pg_notify('ocrefbot_blocklist', 'add:' || NEW.user_id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS ocrefbot_blocklist_notify ON ocrefbot_blocklist',
+    """CREATE TRIGGER ocrefbot_blocklist_notify AFTER INSERT OR DELETE ON ocrefbot_blocklist
+    FOR EACH ROW EXECUTE FUNCTION ocrefbot_blocklist_notify()""",
 )
 
 
+@_timed
 async def create_tables(conn):
     # await conn.execute("DROP TABLE IF EXISTS tbl")
-    await conn.execute(
-        """CREATE TABLE IF NOT EXISTS ocrefbot_users (
-            id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            is_premium BOOL,
-            language_code TEXT,
-            created_at TIMESTAMP NOT NULL DEFAULT now(),
-            messages_count INTEGER NOT NULL DEFAULT 0
-        )"""
-    )
-    await conn.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";')
-    await conn.execute(
-        """CREATE TABLE IF NOT EXISTS ocrefbot_refs (
-            id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-            user_id INTEGER NOT NULL REFERENCES ocrefbot_users(id) ON DELETE CASCADE,
-            ref_name TEXT NOT NULL,
-            doc_file_id TEXT,
-            photo_file_id TEXT,
-            created_at TIMESTAMP NOT NULL DEFAULT now(),
-            used_at TIMESTAMP DEFAULT NULL,
-            used_count INTEGER NOT NULL DEFAULT 0,
-            UNIQUE(user_id, ref_name)
-        )"""
-    )
+    for statement in _SCHEMA:
+        await conn.execute(statement)
 
 
-async def msg_from_user(conn: SAConnection, user_id: int, username: str, first_name: str, last_name: str, is_premium: bool, language_code: str):
-    query = (
-        pg_insert(tbl_users)
-        .values({'id': user_id, 'username': username, 'first_name': first_name, 'last_name': last_name, 'messages_count': 1, 'is_premium': is_premium, 'language_code': language_code})
-        .on_conflict_do_update(
-            index_elements=('id',),
-            set_={
-                'messages_count': tbl_users.c.messages_count + 1,
-                'username': username, 'first_name': first_name, 'last_name': last_name, 'is_premium': is_premium, 'language_code': language_code,
-            }
-        )
-        .returning(tbl_users)
+_SCHEMA_FINGERPRINT = hashlib.sha256('\n'.join(_SCHEMA).encode()).hexdigest()
+# any constant, only bot instances take this lock
+_SCHEMA_LOCK_ID = 0x6f637265
+
+
+@_timed
+async def get_meta(conn: SAConnection, key: str) -> str | None:
+    try:
+        return await conn.scalar(sa.select(tbl_meta.c.value).where(tbl_meta.c.key == key))
+    except psycopg2.errors.UndefinedTable:
+        return None
+
+
+@_timed
+async def set_meta(conn: SAConnection, key: str, value: str) -> None:
+    query = pg_insert(tbl_meta).values(key=key, value=value)
+    query = query.on_conflict_do_update(index_elements=('key',), set_={'value': query.excluded.value})
+    await conn.execute(query)
+
+
+@_timed
+async def ensure_schema(conn: SAConnection) -> bool:
+    # creates or updates schema only if it was changed, returns whether it was
+    if await get_meta(conn, 'schema') == _SCHEMA_FINGERPRINT:
+        return False
+    # instances started at once must not run DDL concurrently
+    await conn.execute(sa.select(sa.func.pg_advisory_lock(_SCHEMA_LOCK_ID)))
+    try:
+        if await get_meta(conn, 'schema') == _SCHEMA_FINGERPRINT:
+            return False
+        await create_tables(conn)
+        await set_meta(conn, 'schema', _SCHEMA_FINGERPRINT)
+        return True
+    finally:
+        await conn.execute(sa.select(sa.func.pg_advisory_unlock(_SCHEMA_LOCK_ID)))
+
+
+@_timed
+async def save_users(conn: SAConnection, users: list[dict]) -> None:
+    query = pg_insert(tbl_users).values(users)
+    query = query.on_conflict_do_update(
+        index_elements=('id',),
+        set_={
+            'messages_count': tbl_users.c.messages_count + query.excluded.messages_count,
+            'username': query.excluded.username,
+            'first_name': query.excluded.first_name,
+            'last_name': query.excluded.last_name,
+            'is_premium': query.excluded.is_premium,
+            'language_code': query.excluded.language_code,
+        }
     )
-    return await (await conn.execute(query)).fetchone()
+    await conn.execute(query)
+
+
+# callbacks run after transactions of units of work are committed, by their connections
+_commit_callbacks: dict[SAConnection, list[Callable[[], None]]] = {}
+
+
+def after_commit(conn: SAConnection, callback: Callable[[], None]) -> None:
+    # runs callback once changes done on connection are visible to others: right away, or after the transaction
+    # of the update is committed. Callbacks of rolled back transactions are not run
+    callbacks = _commit_callbacks.get(conn)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+def _refs_changed(user_id: int) -> None:
+    ref_cache.invalidate(user_id)
+    recent_writes.add(user_id)
 
 
 class RefAlreadyExistsError(Exception):
@@ -90,61 +294,404 @@ class RefAlreadyExistsError(Exception):
 class UserNotFoundError(Exception):
     pass
 
-async def add_ref(conn: SAConnection, user_id: int, ref_name: str, doc_file_id: str, photo_file_id: str):
+
+_add_ref = Statement('add_ref', (
+    pg_insert(tbl_refs)
+    .values({
+        column: sa.bindparam(column)
+        for column in (
+            'user_id', 'ref_name', 'doc_file_id', 'photo_file_id', 'doc_file_unique_id', 'photo_file_unique_id',
+        )
+    })
+    # not failing on conflict, so transaction of the update is not aborted
+    .on_conflict_do_nothing(index_elements=('user_id', 'ref_name'))
+    .returning(tbl_refs)
+))
+
+
+@_timed
+async def add_ref(conn: SAConnection, user_id: int, ref: dict) -> RowProxy:
+    # ref is dict with the same keys as in `add_refs()`
+    try:
+        added = await (await _add_ref.execute(conn, user_id=user_id, **ref)).fetchone()
+    except psycopg2.errors.ForeignKeyViolation:
+        raise UserNotFoundError from None
+    if added is None:
+        raise RefAlreadyExistsError
+    after_commit(conn, functools.partial(_refs_changed, user_id))
+    return added
+
+
+@_timed
+async def add_refs(conn: SAConnection, user_id: int, refs: list[dict]) -> set[str]:
+    # refs are dicts with `ref_name`, `doc_file_id`, `photo_file_id`, `doc_file_unique_id` and `photo_file_unique_id`,
+    # returns names of added ones, others already exist
     query = (
         pg_insert(tbl_refs)
-        .values(
-            {
-                'user_id': user_id,
-                'ref_name': ref_name,
-                'doc_file_id': doc_file_id,
-                'photo_file_id': photo_file_id
-            }
-        )
-        .returning(tbl_refs)
+        .values([{'user_id': user_id, **ref} for ref in refs])
+        .on_conflict_do_nothing(index_elements=('user_id', 'ref_name'))
+        .returning(tbl_refs.c.ref_name)
     )
     try:
-        return await (await conn.execute(query)).fetchone()
-    except psycopg2.errors.UniqueViolation:
-        raise RefAlreadyExistsError
+        added = {row.ref_name for row in await (await conn.execute(query)).fetchall()}
     except psycopg2.errors.ForeignKeyViolation:
-        raise UserNotFoundError
+        raise UserNotFoundError from None
+    after_commit(conn, functools.partial(_refs_changed, user_id))
+    return added
 
 
-async def get_refs(conn: SAConnection, user_id: int, filter: str | None):
-    filter = filter.replace('_', '__').replace('*', '%').replace('?', '_') if filter else None
-    query = (
+def _user_refs_query(*order_by) -> sa.sql.Select:
+    return (
         sa.select(tbl_refs)
-        .where(tbl_refs.c.user_id == user_id)
-        .order_by(sa.tuple_(tbl_refs.c.used_at, tbl_refs.c.created_at).desc())
-        .limit(10)
+        .where(tbl_refs.c.user_id == sa.bindparam('user_id'))
+        .order_by(*order_by, *(column.desc() for column in _refs_order_key))
+        .limit(sa.bindparam('limit'))
     )
+
+
+_get_refs = Statement('get_refs', _user_refs_query())
+# keyset pagination, continues right after the last ref of previous page
+_get_refs_after = Statement('get_refs_after', _user_refs_query().where(
+    sa.tuple_(*_refs_order_key) < sa.tuple_(
+        sa.bindparam('after_score', type_=tbl_refs.c.score.type), sa.bindparam('after_id', type_=tbl_refs.c.id.type),
+    )
+))
+# uses trigram index, exact matches goes first, then similar names (ranked by similarity)
+_matched = tbl_refs.c.ref_name.ilike(sa.bindparam('pattern', type_=sa.TEXT), escape='\\')
+_similarity_text = sa.bindparam('text', type_=sa.TEXT)
+_search_refs = Statement('search_refs', _user_refs_query(
+    _matched.desc(), sa.func.word_similarity(_similarity_text, tbl_refs.c.ref_name).desc(),
+).where(sa.or_(_matched, tbl_refs.c.ref_name.op('%>')(_similarity_text))))
+
+
+@_timed
+async def get_user_refs(conn: SAConnection, user_id: int) -> CachedRefs:
+    generation = ref_cache.generation(user_id)
+    result = await _get_refs.execute(conn, user_id=user_id, limit=ref_cache.max_refs + 1)
+    refs = [dict(ref) for ref in await result.fetchall()]
+    return ref_cache.put(user_id, refs, generation)
+
+
+@_timed
+async def get_refs(conn: SAConnection, user_id: int, filter: str | None, after: dict | None = None,
+                   limit: int = PAGE_SIZE):
     if filter:
-        query = query.where(tbl_refs.c.ref_name.ilike(f'%{filter}%'))
-    return await (await conn.execute(query)).fetchall()
+        result = await _search_refs.execute(
+            conn, user_id=user_id, limit=limit, pattern=like_pattern(filter), text=similarity_text(filter),
+        )
+    elif after:
+        result = await _get_refs_after.execute(
+            conn, user_id=user_id, limit=limit, after_score=after['score'], after_id=after['id'],
+        )
+    else:
+        result = await _get_refs.execute(conn, user_id=user_id, limit=limit)
+    return await result.fetchall()
 
 
-async def ref_sent(conn: SAConnection, ref_id: uuid.UUID):
+@_timed
+async def get_refs_by_docs(conn: SAConnection, user_id: int, doc_file_unique_ids: list[str]) -> dict[str, dict]:
+    # refs with the same documents, one per document, user's own refs are preferred. Their photos are reused
+    # instead of converting documents again, own refs mean that user is adding duplicate
+    query = (
+        sa.select(tbl_refs)
+        .distinct(tbl_refs.c.doc_file_unique_id)
+        .where(tbl_refs.c.doc_file_unique_id.in_(doc_file_unique_ids))
+        .order_by(tbl_refs.c.doc_file_unique_id, (tbl_refs.c.user_id == user_id).desc())
+    )
+    return {ref.doc_file_unique_id: dict(ref) for ref in await (await conn.execute(query)).fetchall()}
+
+
+_get_user_ref_by_photo = Statement('get_user_ref_by_photo', (
+    sa.select(tbl_refs)
+    .where(sa.and_(
+        tbl_refs.c.user_id == sa.bindparam('user_id'),
+        tbl_refs.c.photo_file_unique_id == sa.bindparam('photo_file_unique_id'),
+    ))
+    .limit(1)
+))
+
+
+@_timed
+async def get_user_ref_by_photo(conn: SAConnection, user_id: int, photo_file_unique_id: str) -> RowProxy | None:
+    result = await _get_user_ref_by_photo.execute(conn, user_id=user_id, photo_file_unique_id=photo_file_unique_id)
+    return await result.fetchone()
+
+
+_get_ref = Statement('get_ref', sa.select(tbl_refs).where(tbl_refs.c.id == sa.bindparam('ref_id')))
+
+
+@_timed
+async def get_ref(conn: SAConnection, ref_id: uuid.UUID) -> RowProxy | None:
+    return await (await _get_ref.execute(conn, ref_id=ref_id)).fetchone()
+
+
+@_timed
+async def save_refs_usage(conn: SAConnection, usage: list[tuple[uuid.UUID, int, float]]) -> int:
+    # usage is list of (ref_id, times sent, seconds since last sending)
+    now = time.time()
+    values = sa.values(
+        sa.column('id', sa.TEXT), sa.column('count', sa.INTEGER), sa.column('ago', sa.FLOAT),
+        sa.column('point', sa.FLOAT), name='usage',
+    ).data([(str(ref_id), count, ago, frecency_point(now - ago, count)) for ref_id, count, ago in usage])
+    score, point = tbl_refs.c.score, values.c.point
     query = (
         sa.update(tbl_refs)
-        .values(used_count=tbl_refs.c.used_count + 1, used_at=sa.func.now())
-        .where(tbl_refs.c.id == ref_id)
-        .returning(tbl_refs)
+        .values(
+            used_count=tbl_refs.c.used_count + values.c.count,
+            used_at=sa.func.now() - sa.func.make_interval(0, 0, 0, 0, 0, 0, values.c.ago),
+            # same as `search.add_frecency`, difference is limited, because `exp()` raises error on underflow
+            score=sa.func.greatest(score, point) + sa.func.ln(
+                1 + sa.func.exp(-sa.func.least(sa.func.abs(score - point), 700)),
+            ),
+        )
+        .where(tbl_refs.c.id == sa.cast(values.c.id, UUID))
     )
-    return await (await conn.execute(query)).fetchone()
+    return (await conn.execute(query)).rowcount
+
+
+_del_ref = Statement('del_ref', (
+    sa.delete(tbl_refs)
+    .where(sa.and_(tbl_refs.c.user_id == sa.bindparam('user_id'), tbl_refs.c.id == sa.bindparam('ref_id')))
+))
 
 
+@_timed
 async def del_ref(conn: SAConnection, user_id: int, ref_id: uuid.UUID) -> bool:
+    deleted = bool((await _del_ref.execute(conn, user_id=user_id, ref_id=ref_id)).rowcount)
+    after_commit(conn, functools.partial(_refs_changed, user_id))
+    return deleted
+
+
+_get_fsm = Statement('get_fsm', (
+    sa.select(tbl_fsm.c.state, tbl_fsm.c.data, tbl_fsm.c.version)
+    .where(sa.and_(tbl_fsm.c.chat_id == sa.bindparam('chat_id'), tbl_fsm.c.user_id == sa.bindparam('user_id')))
+))
+
+
+@_timed
+async def get_fsm(conn: SAConnection, chat_id: int, user_id: int) -> RowProxy | None:
+    return await (await _get_fsm.execute(conn, chat_id=chat_id, user_id=user_id)).fetchone()
+
+
+@functools.cache
+def _save_fsm_statement(columns: tuple[str, ...]) -> Statement:
+    query = pg_insert(tbl_fsm).values({
+        column: sa.bindparam(column) for column in ('chat_id', 'user_id', 'data', *columns)
+    })
+    return Statement(f'save_fsm_{"_".join(columns)}', (
+        query
+        .on_conflict_do_update(
+            index_elements=('chat_id', 'user_id'),
+            set_={
+                **{column: query.excluded[column] for column in columns},
+                'version': _fsm_next_version,
+                'updated_at': sa.func.now(),
+            },
+        )
+        .returning(tbl_fsm.c.version)
+    ))
+
+
+@_timed
+async def save_fsm(conn: SAConnection, chat_id: int, user_id: int, **values) -> int:
+    # values are `state` and/or `data`, returns new version of the row
+    statement = _save_fsm_statement(tuple(sorted(values)))
+    return await (await statement.execute(conn, chat_id=chat_id, user_id=user_id, **{'data': {}, **values})).scalar()
+
+
+@_timed
+async def delete_stale_fsm(conn: SAConnection, ttl: float) -> int:
+    query = (
+        sa.delete(tbl_fsm)
+        .where(sa.or_(
+            tbl_fsm.c.updated_at < sa.func.now() - sa.func.make_interval(0, 0, 0, 0, 0, 0, ttl),
+            sa.and_(tbl_fsm.c.state.is_(None), tbl_fsm.c.data == sa.cast({}, JSONB)),
+        ))
+    )
+    return (await conn.execute(query)).rowcount
+
+
+@_timed
+async def get_blocked_users(conn: SAConnection) -> set[int]:
+    return {row.user_id for row in await (await conn.execute(sa.select(tbl_blocklist.c.user_id))).fetchall()}
+
+
+@_timed
+async def get_blocklist(conn: SAConnection, limit: int) -> list[RowProxy]:
+    query = sa.select(tbl_blocklist).order_by(tbl_blocklist.c.created_at.desc()).limit(limit)
+    return await (await conn.execute(query)).fetchall()
+
+
+@_timed
+async def block_user(conn: SAConnection, user_id: int, reason: str | None) -> bool:
     query = (
-        sa.delete(tbl_refs)
-        .where(sa.and_(tbl_refs.c.user_id == user_id, tbl_refs.c.id == ref_id))
+        pg_insert(tbl_blocklist)
+        .values(user_id=user_id, reason=reason)
+        .on_conflict_do_nothing(index_elements=('user_id',))
     )
     return bool((await conn.execute(query)).rowcount)
 
 
+@_timed
+async def unblock_user(conn: SAConnection, user_id: int) -> bool:
+    query = sa.delete(tbl_blocklist).where(tbl_blocklist.c.user_id == user_id)
+    return bool((await conn.execute(query)).rowcount)
+
+
+EXPORT_CHUNK_SIZE = 1000
+USER_REFS_EXPORT_COLUMNS = ('ref_name', 'doc_file_id', 'photo_file_id', 'created_at', 'used_at', 'used_count')
+
+
+async def _stream(pg: Engine, query: sa.sql.Select, chunk_size: int) -> AsyncIterator[list]:
+    # rows are fetched by chunks through server side cursor, so whole result is never kept in memory.
+    # Cursor lives in transaction of its own connection, it's closed with the transaction even on early exit
+    compiled = query.compile(dialect=pg.dialect)
+    async with acquire(pg) as conn, conn.begin():
+        await conn.execute(f'DECLARE ocrefbot_export NO SCROLL CURSOR FOR {compiled}', compiled.params)
+        while rows := await (await conn.execute(f'FETCH {chunk_size} FROM ocrefbot_export')).fetchall():
+            yield rows
+
+
+def stream_user_refs(pg: Engine, user_id: int, chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[list]:
+    query = (
+        sa.select(*(tbl_refs.c[column] for column in USER_REFS_EXPORT_COLUMNS))
+        .where(tbl_refs.c.user_id == user_id)
+        .order_by(*(column.desc() for column in _refs_order_key))
+    )
+    return _stream(pg, query, chunk_size)
+
+
+def stream_table(pg: Engine, table: sa.Table, chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[list]:
+    # not ordered, so rows are not sorted on server
+    return _stream(pg, sa.select(table), chunk_size)
+
+
+_pool_names: dict[Engine, str] = {}
+
+
 @contextlib.asynccontextmanager
-async def db_engine():
+async def _pool_metrics(engine: Engine, pool: str) -> AsyncIterator[None]:
+    _pool_names[engine] = pool
+    pool_connections.set_function(lambda: engine.size - engine.freesize, pool=pool, state='used')
+    pool_connections.set_function(lambda: engine.freesize, pool=pool, state='free')
+    pool_connections.set_function(lambda: engine.maxsize, pool=pool, state='max')
+    try:
+        yield
+    finally:
+        del _pool_names[engine]
+
+
+@contextlib.asynccontextmanager
+async def db_engine() -> AsyncIterator[Engine]:
     async with create_engine(
-        user=settings.db_user, database=settings.db_db, host=settings.db_host, password=settings.db_pass,
-    ) as engine:
+        user=settings.db_user, database=settings.db_db, host=settings.db_host, port=settings.db_port,
+        password=settings.db_pass, minsize=settings.db_pool_min_size, maxsize=settings.db_pool_max_size,
+    ) as engine, _pool_metrics(engine, 'primary'):
         yield engine
+
+
+@contextlib.asynccontextmanager
+async def replica_engine(primary: Engine) -> AsyncIterator[Engine | None]:
+    # None if replica is not configured. `create_engine()` connects right away, so replica engine is made of pool
+    # without connections opened in advance and dialect of primary one, bot starts with replica down
+    if settings.db_replica_host is None:
+        yield None
+        return
+    dsn = psycopg2.extensions.make_dsn(
+        user=settings.db_user, dbname=settings.db_db, host=settings.db_replica_host,
+        port=settings.db_replica_port or settings.db_port, password=settings.db_pass,
+    )
+    async with aiopg.create_pool(dsn, minsize=0, maxsize=settings.db_pool_max_size) as pool:
+        engine = Engine(primary.dialect, pool, dsn)
+        async with _pool_metrics(engine, 'replica'):
+            yield engine
+
+
+async def _acquire(pg: Engine, timeout: float | None = None) -> SAConnection:
+    pool = _pool_names.get(pg, 'primary')
+    started_at = time.perf_counter()
+    try:
+        async with asyncio.timeout(settings.db_acquire_timeout if timeout is None else timeout):
+            return await pg.acquire()
+    except TimeoutError:
+        pool_timeouts.inc(pool=pool)
+        raise
+    finally:
+        pool_wait_seconds.observe(time.perf_counter() - started_at, pool=pool)
+
+
+@contextlib.asynccontextmanager
+async def acquire(pg: Engine, timeout: float | None = None) -> AsyncIterator[SAConnection]:
+    # same as `pg.acquire()`, but with timeout and waiting time metric
+    conn = await _acquire(pg, timeout)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+_set_statement_timeout = Statement('set_statement_timeout', sa.select(
+    sa.func.set_config('statement_timeout', sa.bindparam('timeout', type_=sa.TEXT), sa.true()),
+))
+
+
+@contextlib.asynccontextmanager
+async def acquire_until(pg: Engine, deadline: float) -> AsyncIterator[SAConnection]:
+    # connection for queries that are useless after `deadline` (event loop time). Both waiting for pool and
+    # queries are limited by time left. Statement timeout is set for transaction only, so it doesn't stay in pool
+    loop = asyncio.get_running_loop()
+    async with acquire(pg, max(deadline - loop.time(), 0)) as conn, conn.begin():
+        left = deadline - loop.time()
+        if left <= 0:
+            raise TimeoutError
+        await _set_statement_timeout.execute(conn, timeout=f'{math.ceil(left * 1000)}ms')
+        try:
+            yield conn
+        except asyncio.CancelledError:
+            # aiopg raises statement cancelled by timeout as CancelledError, real cancellation is passed as is
+            if asyncio.current_task().cancelling():
+                raise
+            raise TimeoutError('Statement timeout') from None
+
+
+class UnitOfWork:
+    # One connection per update, acquired on first use only. With `transaction` all queries
+    # of the update are done in one transaction, committed after handler succeeded
+    def __init__(self, pg: Engine, *, transaction: bool) -> None:
+        self.pg = pg
+        self.transaction = transaction
+        self._conn: SAConnection | None = None
+        self._transaction = None
+
+    async def connection(self) -> SAConnection:
+        if self._conn is None:
+            self._conn = await _acquire(self.pg)
+            if self.transaction:
+                self._transaction = await self._conn.begin()
+                _commit_callbacks[self._conn] = []
+        return self._conn
+
+    async def release(self) -> None:
+        # returns connection to pool before long work without queries, next `connection()` acquires it again.
+        # Connection with transaction is kept till the end of the update
+        if self._conn is None or self._transaction is not None:
+            return
+        await self._conn.close()
+        self._conn = None
+
+    async def close(self, *, success: bool) -> None:
+        if self._conn is None:
+            return
+        callbacks = _commit_callbacks.pop(self._conn, [])
+        try:
+            if self._transaction is not None and self._transaction.is_active:
+                if success:
+                    await self._transaction.commit()
+                else:
+                    await self._transaction.rollback()
+        finally:
+            await self._conn.close()
+            self._conn = self._transaction = None
+        if success:
+            for callback in callbacks:
+                callback()
@@ -0,0 +1,34 @@
+import contextlib
+import csv
+import gzip
+import io
+import tempfile
+from collections.abc import AsyncIterator, Sequence
+
+from aiogram.types import FSInputFile
+
+
+@contextlib.asynccontextmanager
+async def csv_document(
+        filename: str, header: Sequence[str], chunks: AsyncIterator[list], *, compress: bool,
+) -> AsyncIterator[tuple[FSInputFile, int]]:
+    # writes rows to temporary file chunk by chunk and yields it ready for sending with number of rows,
+    # so memory usage does not depend on number of rows. Sending file is streamed from disk too
+    with tempfile.NamedTemporaryFile(prefix='ocrefbot_', suffix='.csv.gz' if compress else '.csv') as file:
+        raw = gzip.GzipFile(fileobj=file, mode='wb') if compress else file
+        text = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(header)
+        rows = 0
+        # closes cursor and its transaction right away, even if writing failed
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                writer.writerows(row.values() for row in chunk)
+                rows += len(chunk)
+        # closing of wrapper would close and delete temporary file
+        text.flush()
+        text.detach()
+        if compress:
+            raw.close()
+        file.flush()
+        yield FSInputFile(file.name, filename=f'{filename}.gz' if compress else filename), rows
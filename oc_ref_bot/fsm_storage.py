@@ -0,0 +1,159 @@
+import asyncio
+import contextlib
+import logging
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from typing import Any, NamedTuple, Self
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiopg.sa import Engine, SAConnection
+
+from oc_ref_bot.database import get_fsm, save_fsm, delete_stale_fsm, acquire, after_commit, UnitOfWork
+
+log = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'ocrefbot_fsm'
+
+
+class _Record(NamedTuple):
+    state: str | None
+    data: dict[str, Any]
+    version: int
+
+
+class PgStorage(BaseStorage):
+    # FSM storage shared by all bot instances. Row per (chat, user), thread and destiny are not used by the bot.
+    # Records are cached locally and dropped from cache by notifications about newer versions from DB.
+    # Last notified versions are kept too, so record read before a notification but received after it isn't cached
+    def __init__(self, pg: Engine, cache_size: int, state_ttl: float, cleanup_interval: float) -> None:
+        self.pg = pg
+        self.cache_size = cache_size
+        self.state_ttl = state_ttl
+        self.cleanup_interval = cleanup_interval
+        self._cache: OrderedDict[tuple[int, int], _Record] = OrderedDict()
+        self._notified: OrderedDict[tuple[int, int], int] = OrderedDict()
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> Self:
+        self._task = asyncio.create_task(self._cleanup_loop())
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    def on_notify(self, payload: str) -> None:
+        chat_id, user_id, version = map(int, payload.split(':'))
+        key = chat_id, user_id
+        self._notified[key] = max(version, self._notified.get(key, 0))
+        self._notified.move_to_end(key)
+        while len(self._notified) > self.cache_size:
+            self._notified.popitem(last=False)
+        record = self._cache.get(key)
+        if record and record.version < version:
+            del self._cache[key]
+
+    def on_reconnect(self) -> None:
+        self._cache.clear()
+        self._notified.clear()
+
+    def _remember(self, key: tuple[int, int], record: _Record) -> None:
+        cached = self._cache.get(key)
+        if cached and cached.version > record.version:
+            return
+        if self._notified.get(key, 0) > record.version:
+            # newer version was saved while this one was being read
+            return
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def bind(self, db: UnitOfWork) -> BaseStorage:
+        # the same storage using connection of the update instead of its own one
+        return _UnitOfWorkStorage(self, db)
+
+    @contextlib.asynccontextmanager
+    async def _connection(self, db: UnitOfWork | None) -> AsyncIterator[SAConnection]:
+        if db is None:
+            async with acquire(self.pg) as conn:
+                yield conn
+        else:
+            yield await db.connection()
+
+    async def _get(self, key: StorageKey, db: UnitOfWork | None = None) -> _Record:
+        cache_key = key.chat_id, key.user_id
+        record = self._cache.get(cache_key)
+        if record is not None:
+            self._cache.move_to_end(cache_key)
+            return record
+        async with self._connection(db) as conn:
+            row = await get_fsm(conn, key.chat_id, key.user_id)
+            # uncommitted changes, even own ones, must not get to cache
+            committed = not conn.in_transaction
+        record = _Record(row['state'], row['data'], row['version']) if row else _Record(None, {}, 0)
+        if committed:
+            self._remember(cache_key, record)
+        return record
+
+    async def _save(self, key: StorageKey, db: UnitOfWork | None, **values: Any) -> None:
+        cache_key = key.chat_id, key.user_id
+        async with self._connection(db) as conn:
+            version = await save_fsm(conn, key.chat_id, key.user_id, **values)
+            if conn.in_transaction:
+                # record is read again, once the change is committed
+                self._cache.pop(cache_key, None)
+                after_commit(conn, lambda: self._cache.pop(cache_key, None))
+                return
+        cached = self._cache.get(cache_key)
+        if cached:
+            self._remember(cache_key, cached._replace(version=version, **values))
+
+    async def set_state(self, key: StorageKey, state: StateType = None, db: UnitOfWork | None = None) -> None:
+        await self._save(key, db, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey, db: UnitOfWork | None = None) -> str | None:
+        return (await self._get(key, db)).state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any], db: UnitOfWork | None = None) -> None:
+        await self._save(key, db, data=data.copy())
+
+    async def get_data(self, key: StorageKey, db: UnitOfWork | None = None) -> dict[str, Any]:
+        return (await self._get(key, db)).data.copy()
+
+    async def close(self) -> None:
+        pass
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                async with acquire(self.pg) as conn:
+                    deleted = await delete_stale_fsm(conn, self.state_ttl)
+                log.info('Deleted %s stale FSM states', deleted)
+            except Exception:
+                log.exception('FSM states cleanup failed')
+
+
+class _UnitOfWorkStorage(BaseStorage):
+    # PgStorage bound to unit of work of the update, so handlers don't need second pooled connection for FSM
+    def __init__(self, storage: PgStorage, db: UnitOfWork) -> None:
+        self.storage = storage
+        self.db = db
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self.storage.set_state(key, state, self.db)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await self.storage.get_state(key, self.db)
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self.storage.set_data(key, data, self.db)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return await self.storage.get_data(key, self.db)
+
+    async def close(self) -> None:
+        pass
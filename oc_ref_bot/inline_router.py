@@ -1,25 +1,119 @@
+import asyncio
+import functools
 import logging
 import uuid
+from collections.abc import Awaitable, Callable
+from typing import Any
 
+import psycopg2
 from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineQuery, InlineQueryResultCachedPhoto, InlineQueryResultCachedDocument, \
     ChosenInlineResult, ReplyKeyboardMarkup, KeyboardButton
-from aiopg.sa import Engine
+from aiopg.sa import SAConnection
 
+from oc_ref_bot.circuit_breaker import CircuitBreaker, CircuitOpenError
 from oc_ref_bot.cmd_router import ChatState
-from oc_ref_bot.database import get_refs
-from oc_ref_bot.database import ref_sent as db_ref_sent
+from oc_ref_bot.coalesce import InlineCoalescer
+from oc_ref_bot.config import settings
+from oc_ref_bot.database import get_refs, get_user_refs, get_ref, UnitOfWork
+from oc_ref_bot.metrics import Counter
+from oc_ref_bot.ref_cache import ref_cache, last_results
+from oc_ref_bot.replica import ReadRouter
+from oc_ref_bot.search import filter_refs, paginate_refs, encode_offset, decode_offset, PAGE_SIZE
+from oc_ref_bot.write_behind import UsageBuffer
 
 router = Router()
 
 log = logging.getLogger(__name__)
 
+degraded_answers = Counter('ocrefbot_inline_degraded_total', 'Inline queries answered without fresh results')
+
+
+# runs query of inline lookup, limited by its deadline and guarded by breaker
+Read = Callable[[Callable[[SAConnection], Awaitable[Any]]], Awaitable[Any]]
+
+
+async def _read(
+        reads: ReadRouter, breaker: CircuitBreaker, user_id: int, deadline: float,
+        query: Callable[[SAConnection], Awaitable[Any]],
+) -> Any:
+    async with breaker.guard():
+        return await reads.read(user_id, deadline, query)
+
+
+async def find_refs(
+        read: Read, coalescer: InlineCoalescer, user_id: int, filter: str | None, offset: str,
+) -> tuple[list[dict], str]:
+    # lookups may be shared by several updates, so they use own connections instead of update's one
+    cached = ref_cache.get(user_id)
+    if cached is None:
+        # queries typed while refs are loaded wait for the same loading
+        cached = await coalescer.share(
+            ('user_refs', user_id), lambda: read(lambda conn: get_user_refs(conn, user_id)),
+        )
+    if filter:
+        # search results are ranked by similarity, so only first page is shown
+        if cached.complete:
+            return filter_refs(cached.refs, filter, limit=PAGE_SIZE), ''
+        refs = await read(lambda conn: get_refs(conn, user_id, filter))
+        return [dict(ref) for ref in refs], ''
+
+    after = decode_offset(offset) if offset else None
+    refs = paginate_refs(cached.refs, after, limit=PAGE_SIZE + 1)
+    if not cached.complete and len(refs) <= PAGE_SIZE:
+        # page is out of cached refs
+        refs = await read(lambda conn: get_refs(conn, user_id, None, after, limit=PAGE_SIZE + 1))
+        refs = [dict(ref) for ref in refs]
+    next_offset = encode_offset(refs[PAGE_SIZE - 1]) if len(refs) > PAGE_SIZE else ''
+    return refs[:PAGE_SIZE], next_offset
+
+
+def _degraded_refs(user_id: int, query: str, offset: str, error: Exception) -> tuple[list[dict], str]:
+    if isinstance(error, CircuitOpenError):
+        reason = 'breaker'
+    elif isinstance(error, TimeoutError):
+        reason = 'timeout'
+    else:
+        reason = 'error'
+    stale = last_results.get(user_id, query, offset)
+    degraded_answers.inc(reason=reason, result='empty' if stale is None else 'stale')
+    log.warning('Inline query of user %s answered with %s results (%s): %r',
+                user_id, 'no' if stale is None else 'stale', reason, error)
+    return stale or ([], '')
+
 
 @router.inline_query(F.query.len() >= 0)
-async def show_user_refs(inline_query: InlineQuery, pg: Engine):
-    async with pg.acquire() as conn:
-        refs = [dict(ref) for ref in await get_refs(conn, inline_query.from_user.id, inline_query.query)]
+async def show_user_refs(
+        inline_query: InlineQuery, read_router: ReadRouter, inline_coalescer: InlineCoalescer,
+        db_breaker: CircuitBreaker,
+):
+    user_id = inline_query.from_user.id
+    query, offset = inline_query.query, inline_query.offset
+    # Telegram drops queries not answered in a few seconds, so late results are useless
+    deadline = asyncio.get_running_loop().time() + settings.inline_deadline
+    read = functools.partial(_read, read_router, db_breaker, user_id, deadline)
+    inline_coalescer.arrived(user_id, inline_query.id)
+    try:
+        try:
+            # shared lookup isn't cancelled by timeout here, it's stopped by statement timeout on its own
+            async with asyncio.timeout_at(deadline):
+                refs, next_offset = await inline_coalescer.share(
+                    (user_id, query, offset),
+                    lambda: find_refs(read, inline_coalescer, user_id, query, offset),
+                )
+        except (TimeoutError, CircuitOpenError, psycopg2.Error) as e:
+            refs, next_offset = _degraded_refs(user_id, query, offset, e)
+            # asked again soon, when database is hopefully fine
+            cache_time = settings.inline_stale_cache_time
+        else:
+            last_results.put(user_id, query, offset, refs, next_offset)
+            cache_time = 30
+        if inline_coalescer.superseded(user_id, inline_query.id):
+            # user already typed something else, this answer won't be shown anyway
+            return None
+    finally:
+        inline_coalescer.done(user_id, inline_query.id)
 
     results = []
     for ref in refs:
@@ -37,20 +131,22 @@ async def show_user_refs(inline_query: InlineQuery, pg: Engine):
                     title=ref['ref_name'],
                 )
             )
-    await inline_query.answer(cache_time=30, is_personal=True, results=results)
     log.info('User %s choosing ref in chat type %s', inline_query.from_user.full_name, inline_query.chat_type)
+    # returned instead of awaited, so in webhook mode it's sent right in the webhook response
+    return inline_query.answer(cache_time=cache_time, is_personal=True, results=results, next_offset=next_offset)
 
 
 @router.chosen_inline_result()
-async def ref_sent(inline_result: ChosenInlineResult, state: FSMContext, pg: Engine):
+async def ref_sent(inline_result: ChosenInlineResult, state: FSMContext, db: UnitOfWork, usage_buffer: UsageBuffer):
     sent_as_photo = inline_result.result_id.startswith('ph_')
     sent_as_doc = inline_result.result_id.startswith('doc_')
     sent_ref_id = uuid.UUID(inline_result.result_id.replace('ph_', '').replace('doc_', ''))
-    async with pg.acquire() as conn:
-        ref = await db_ref_sent(conn, ref_id=sent_ref_id)
+    usage_buffer.add(sent_ref_id)
+    ref_cache.ref_used(inline_result.from_user.id, sent_ref_id)
     log.info('User %s sent ref via bot as %s', inline_result.from_user.full_name, 'document' if sent_as_doc else 'photo')
 
     if (await state.get_state()) == ChatState.del_ref:
+        ref = await get_ref(await db.connection(), sent_ref_id)
         if not ref:
             await state.clear()
             await inline_result.bot.send_message(
@@ -59,7 +155,7 @@ async def ref_sent(inline_result: ChosenInlineResult, state: FSMContext, pg: Eng
             )
             return
         await state.set_state(ChatState.del_ref_confirm)
-        await state.set_data({'ref_id': sent_ref_id})
+        await state.set_data({'ref_id': str(sent_ref_id)})
         await inline_result.bot.send_message(inline_result.from_user.id, 'Ты точно хочешь удалить рефку с этим персонажем?')
         await inline_result.bot.send_photo(
             inline_result.from_user.id,
@@ -1,21 +1,46 @@
+import asyncio
+import logging
+import math
+import sys
+import time
+from typing import Any
+
 import sentry_sdk
 
+from oc_ref_bot.bot import main_bot
 from oc_ref_bot.config import settings
+from oc_ref_bot.startup import phase
 
-sentry_sdk.init(
-    dsn=settings.sentry_dsn,
-    traces_sample_rate=1.0,
-    profiles_sample_rate=1.0,
-)
+logger = logging.getLogger(__name__)
 
 
-import asyncio
-import logging
-import sys
+class _TracesSampler:
+    # low base rate, but traces are sampled much more often for a while after an error, to see what happened around it
+    def __init__(self) -> None:
+        self.last_error_at = -math.inf
 
-from oc_ref_bot.bot import main_bot
+    def before_send(self, event: dict[str, Any], hint: dict[str, Any]) -> dict[str, Any]:
+        self.last_error_at = time.monotonic()
+        return event
 
-logger = logging.getLogger(__name__)
+    def __call__(self, sampling_context: dict[str, Any]) -> float | bool:
+        if sampling_context.get('parent_sampled') is not None:
+            return sampling_context['parent_sampled']
+        if time.monotonic() - self.last_error_at < settings.sentry_error_boost_duration:
+            return settings.sentry_error_traces_sample_rate
+        return settings.sentry_traces_sample_rate
+
+
+def init_sentry() -> None:
+    # not on import, so importing bot modules (by benchmarks or tools) does not start reporting
+    traces_sampler = _TracesSampler()
+    sentry_sdk.init(
+        dsn=settings.sentry_dsn,
+        traces_sampler=traces_sampler,
+        # share of sampled traces which are profiled too
+        profiles_sample_rate=settings.sentry_profiles_sample_rate,
+        before_send=traces_sampler.before_send,
+    )
 
 
 async def main_async() -> None:
@@ -25,6 +50,8 @@ async def main_async() -> None:
 
 def main() -> None:
     logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
+    with phase('sentry'):
+        init_sentry()
     asyncio.run(main_async())
 
 
@@ -0,0 +1,140 @@
+import bisect
+import contextlib
+import logging
+import time
+from collections.abc import Callable, Iterator
+from typing import Self
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        registry.append(self)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self.values: dict[tuple[tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self.values: dict[tuple[tuple[str, str], ...], float] = {}
+        self.functions: dict[tuple[tuple[str, str], ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        # value is taken from `function` at rendering only, so it costs nothing on the hot path
+        self.functions[tuple(sorted(labels.items()))] = function
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation)
+        self.buckets = buckets
+        # labels -> (count per bucket, sum, count)
+        self.values: dict[tuple[tuple[str, str], ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        buckets, total, count = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(buckets):
+            buckets[index] += 1
+        self.values[key] = (buckets, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+
+registry: list[Metric] = []
+
+
+def _labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render() -> str:
+    # Prometheus text exposition format
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        if isinstance(metric, Histogram):
+            for labels, (buckets, total, count) in list(metric.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets, buckets, strict=True):
+                    cumulative += bucket_count
+                    lines.append(f'{metric.name}_bucket{_labels((*labels, ("le", str(bound))))} {cumulative}')
+                lines.append(f'{metric.name}_bucket{_labels((*labels, ("le", "+Inf")))} {count}')
+                lines.append(f'{metric.name}_sum{_labels(labels)} {total}')
+                lines.append(f'{metric.name}_count{_labels(labels)} {count}')
+        else:
+            values = dict(metric.values)
+            if isinstance(metric, Gauge):
+                for labels, function in metric.functions.items():
+                    try:
+                        values[labels] = function()
+                    except Exception:
+                        log.exception('Collecting %s failed', metric.name)
+            for labels, value in values.items():
+                lines.append(f'{metric.name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+class MetricsServer:
+    # Serves metrics for Prometheus on its own port, separately from webhook, so they are never exposed publicly
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def __aenter__(self) -> Self:
+        app = web.Application()
+        app.router.add_get('/metrics', _handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info('Metrics server listening on %s:%s', self.host, self.port)
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self._runner.cleanup()
@@ -0,0 +1,56 @@
+import asyncio
+import contextlib
+import logging
+from typing import Protocol, Self
+
+from aiopg.sa import Engine
+
+log = logging.getLogger(__name__)
+
+
+class Subscriber(Protocol):
+    def on_notify(self, payload: str) -> None:
+        ...
+
+    # notifications sent while connection was lost are missed, so everything that could get stale must be dropped
+    def on_reconnect(self) -> None:
+        ...
+
+
+class Listener:
+    # Keeps one connection with LISTEN on subscribed channels and passes NOTIFY payloads to subscribers
+    def __init__(self, pg: Engine, subscribers: dict[str, Subscriber], reconnect_delay: float = 5) -> None:
+        self.pg = pg
+        self.subscribers = subscribers
+        self.reconnect_delay = reconnect_delay
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> Self:
+        self._task = asyncio.create_task(self._listen())
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.pg.acquire() as conn:
+                    try:
+                        for channel, subscriber in self.subscribers.items():
+                            await conn.execute(f'LISTEN {channel}')
+                            subscriber.on_reconnect()
+                        log.info('Listening to %s', ', '.join(self.subscribers))
+                        while True:
+                            notify = await conn.connection.notifies.get()
+                            self.subscribers[notify.channel].on_notify(notify.payload)
+                    finally:
+                        if not conn.closed and not asyncio.current_task().cancelling():
+                            await conn.execute('UNLISTEN *')
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Listening for notifications failed, reconnecting')
+                await asyncio.sleep(self.reconnect_delay)
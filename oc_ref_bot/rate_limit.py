@@ -0,0 +1,149 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, Response, AnswerInlineQuery, AnswerCallbackQuery
+
+from oc_ref_bot.metrics import Histogram, Counter
+
+log = logging.getLogger(__name__)
+
+queue_seconds = Histogram('ocrefbot_api_queue_seconds', 'Time Bot API requests waited for rate limiter')
+retries = Counter('ocrefbot_api_retries_total', 'Bot API requests retried after flood limit')
+
+# answers are waited by users right now, so they go before everything else
+PRIORITY_ANSWER = 0
+PRIORITY_SEND = 1
+
+_ANSWER_METHODS = (AnswerInlineQuery, AnswerCallbackQuery)
+# idle chat buckets are dropped once there are so many of them
+MAX_CHAT_BUCKETS = 10_000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self) -> float:
+        # takes token if there is one, otherwise returns seconds until it will be
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        # takes token in advance, returns seconds to wait before using it
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return max(self.blocked_until - now, -self.tokens / self.rate, 0)
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+
+class PriorityLimiter:
+    # Token bucket with waiters served by priority, then in order of arrival
+    def __init__(self, rate: float, burst: float) -> None:
+        self.bucket = TokenBucket(rate, burst)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._task: asyncio.Task | None = None
+
+    async def acquire(self, priority: int) -> None:
+        if not self._waiters and not self.bucket.take():
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._wake_up())
+        await waiter
+
+    async def _wake_up(self) -> None:
+        while self._waiters:
+            if wait := self.bucket.take():
+                await asyncio.sleep(wait)
+                continue
+            while self._waiters:
+                _, _, waiter = heapq.heappop(self._waiters)
+                # cancelled waiters don't need token
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+            else:
+                # nobody took it
+                self.bucket.tokens += 1
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    # Keeps outgoing requests within Telegram flood limits: global limit for all chats and limit for every chat.
+    # Requests failed with flood limit are retried after time requested by Telegram, except inline answers,
+    # which are useless after a few seconds. Methods not sending anything to chats are not limited
+    def __init__(
+            self, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int, max_retry_after: float,
+    ) -> None:
+        self.global_limiter = PriorityLimiter(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._chats: dict[int | str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                # buckets of chats not written recently are the same as new ones
+                self._chats = {chat: bucket for chat, bucket in self._chats.items() if not bucket.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def __call__(
+            self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod,
+    ) -> Response:
+        is_answer = isinstance(method, _ANSWER_METHODS)
+        chat_id = getattr(method, 'chat_id', None)
+        if not is_answer and chat_id is None:
+            return await make_request(bot, method)
+        name = method.__api_method__
+        attempt = 0
+        while True:
+            started_at = time.perf_counter()
+            if chat_id is not None:
+                await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+            await self.global_limiter.acquire(PRIORITY_ANSWER if is_answer else PRIORITY_SEND)
+            queue_seconds.observe(time.perf_counter() - started_at, method=name)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+                else:
+                    self.global_limiter.bucket.block(e.retry_after)
+                if is_answer or attempt > self.max_retries or e.retry_after > self.max_retry_after:
+                    raise
+                retries.inc(method=name)
+                log.warning('Flood limit on %s to %s, retrying in %s s', name, chat_id, e.retry_after)
@@ -0,0 +1,173 @@
+import datetime
+import itertools
+import time
+from collections import OrderedDict
+from typing import Any, NamedTuple
+
+from oc_ref_bot.config import settings
+from oc_ref_bot.metrics import Counter
+from oc_ref_bot.search import ref_key, add_frecency, frecency_point
+
+Ref = dict[str, Any]
+
+NOTIFY_CHANNEL = 'ocrefbot_refs'
+
+lookups = Counter('ocrefbot_ref_cache_lookups_total', 'Ref cache lookups by result')
+
+
+class CachedRefs(NamedTuple):
+    refs: tuple[Ref, ...]
+    # False if user has more refs than `max_refs`, so only first refs are cached and search must go to DB
+    complete: bool
+
+
+class RefCache:
+    def __init__(self, max_users: int, max_refs: int, ttl: float) -> None:
+        self.max_users = max_users
+        self.max_refs = max_refs
+        self.ttl = ttl
+        # changes of refs are numbered per user, so refs loaded before a change of their user don't get cached after
+        # it. Numbers of users changed long ago are forgotten, the last forgotten one is used for all of them
+        self._changes = itertools.count(1)
+        self._changed: OrderedDict[int, int] = OrderedDict()
+        self._forgotten_change = 0
+        self._data: OrderedDict[int, tuple[float, CachedRefs]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def generation(self, user_id: int) -> int:
+        return self._changed.get(user_id, self._forgotten_change)
+
+    def _change(self, user_id: int) -> None:
+        self._changed[user_id] = next(self._changes)
+        self._changed.move_to_end(user_id)
+        while len(self._changed) > max(self.max_users, 1):
+            self._forgotten_change = self._changed.popitem(last=False)[1]
+
+    def get(self, user_id: int) -> CachedRefs | None:
+        item = self._data.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[user_id]
+            lookups.inc(result='miss')
+            return None
+        self._data.move_to_end(user_id)
+        lookups.inc(result='hit')
+        return item[1]
+
+    def put(self, user_id: int, refs: list[Ref], generation: int) -> CachedRefs:
+        cached = CachedRefs(tuple(refs[:self.max_refs]), complete=len(refs) <= self.max_refs)
+        if self.max_users <= 0 or generation != self.generation(user_id):
+            return cached
+        self._data[user_id] = (time.monotonic() + self.ttl, cached)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_users:
+            self._data.popitem(last=False)
+        return cached
+
+    def update_ref(self, ref: Ref) -> None:
+        self._change(ref['user_id'])
+        item = self._data.get(ref['user_id'])
+        if item is None:
+            return
+        expires_at, cached = item
+        refs = [r for r in cached.refs if r['id'] != ref['id']]
+        if not cached.complete and len(refs) == len(cached.refs):
+            # ref is out of cached part, so we don't know where to put it
+            self.invalidate(ref['user_id'])
+            return
+        refs.append(ref)
+        refs.sort(key=ref_key, reverse=True)
+        self._data[ref['user_id']] = (expires_at, cached._replace(refs=tuple(refs)))
+
+    def ref_used(self, user_id: int, ref_id: Any) -> None:
+        item = self._data.get(user_id)
+        ref = next((r for r in item[1].refs if r['id'] == ref_id), None) if item else None
+        if ref is None:
+            self.invalidate(user_id)
+            return
+        self.update_ref(ref | {
+            'used_at': datetime.datetime.now(),
+            'used_count': ref['used_count'] + 1,
+            'score': add_frecency(ref['score'], frecency_point(time.time())),
+        })
+
+    def invalidate(self, *user_ids: int) -> None:
+        for user_id in user_ids:
+            self._change(user_id)
+            self._data.pop(user_id, None)
+
+    def clear(self) -> None:
+        # refs being loaded may be stale as well
+        self._changed.clear()
+        self._forgotten_change = next(self._changes)
+        self._data.clear()
+
+
+class LastResults:
+    # Last answered inline results of every user, shown when fresh ones can't be got in time
+    def __init__(self, max_users: int) -> None:
+        self.max_users = max_users
+        self._data: OrderedDict[int, tuple[str, str, list[Ref], str]] = OrderedDict()
+
+    def put(self, user_id: int, query: str, offset: str, refs: list[Ref], next_offset: str) -> None:
+        if self.max_users <= 0:
+            return
+        self._data[user_id] = (query, offset, refs, next_offset)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_users:
+            self._data.popitem(last=False)
+
+    def get(self, user_id: int, query: str, offset: str) -> tuple[list[Ref], str] | None:
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        last_query, last_offset, refs, next_offset = item
+        # results of another query are still better than nothing, but can't be paginated further
+        return refs, next_offset if (last_query, last_offset) == (query, offset) else ''
+
+
+class RecentWrites:
+    # Users who changed their refs within last `window` seconds. Replica may lag behind primary,
+    # so they read from primary to see their changes
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._data: OrderedDict[int, float] = OrderedDict()
+
+    def __contains__(self, user_id: int) -> bool:
+        written_at = self._data.get(user_id)
+        return written_at is not None and time.monotonic() - written_at < self.window
+
+    def add(self, user_id: int) -> None:
+        now = time.monotonic()
+        self._data[user_id] = now
+        self._data.move_to_end(user_id)
+        # ordered by time, so expired users are at the beginning
+        while self._data and now - next(iter(self._data.values())) >= self.window:
+            self._data.popitem(last=False)
+
+
+class RefsChanges:
+    # Refs changed through any bot instance come as notifications with id of their user, whose cached refs are
+    # dropped and who reads from primary for a while
+    def __init__(self, cache: RefCache, writes: RecentWrites) -> None:
+        self.cache = cache
+        self.writes = writes
+
+    def on_notify(self, payload: str) -> None:
+        user_id = int(payload)
+        self.cache.invalidate(user_id)
+        self.writes.add(user_id)
+
+    def on_reconnect(self) -> None:
+        self.cache.clear()
+
+
+ref_cache = RefCache(
+    max_users=settings.ref_cache_size,
+    max_refs=settings.ref_cache_max_refs,
+    ttl=settings.ref_cache_ttl,
+)
+last_results = LastResults(max_users=settings.ref_cache_size)
+recent_writes = RecentWrites(window=settings.db_read_your_writes_window)
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+import psycopg2
+from aiopg.sa import Engine, SAConnection
+
+from oc_ref_bot.circuit_breaker import CircuitBreaker, CircuitOpenError
+from oc_ref_bot.database import acquire_until
+from oc_ref_bot.metrics import Counter
+from oc_ref_bot.ref_cache import recent_writes
+
+log = logging.getLogger(__name__)
+
+reads = Counter('ocrefbot_db_reads_total', 'Routed reads by pool')
+replica_fallbacks = Counter('ocrefbot_db_replica_fallbacks_total', 'Reads sent to primary because replica failed')
+
+T = TypeVar('T')
+
+
+class ReadRouter:
+    # Sends reads which may be a bit stale to replica, if it's configured, so they don't compete with writes.
+    # Users who changed their refs recently read from primary. When replica fails, reads go to primary,
+    # replica is tried again after breaker reset timeout
+    def __init__(self, primary: Engine, replica: Engine | None, breaker: CircuitBreaker) -> None:
+        self.primary = primary
+        self.replica = replica
+        self.breaker = breaker
+
+    async def read(self, user_id: int, deadline: float, query: Callable[[SAConnection], Awaitable[T]]) -> T:
+        if self.replica is not None and user_id not in recent_writes:
+            loop = asyncio.get_running_loop()
+            # half of time left is kept for primary in case replica doesn't answer
+            replica_deadline = loop.time() + (deadline - loop.time()) / 2
+            try:
+                async with self.breaker.guard(), acquire_until(self.replica, replica_deadline) as conn:
+                    result = await query(conn)
+                reads.inc(pool='replica')
+                return result
+            except CircuitOpenError:
+                replica_fallbacks.inc(reason='breaker')
+            except (TimeoutError, psycopg2.Error) as e:
+                replica_fallbacks.inc(reason='timeout' if isinstance(e, TimeoutError) else 'error')
+                log.warning('Reading from replica failed, reading from primary: %r', e)
+        async with acquire_until(self.primary, deadline) as conn:
+            result = await query(conn)
+        reads.inc(pool='primary')
+        return result
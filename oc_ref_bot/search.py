@@ -0,0 +1,106 @@
+import base64
+import binascii
+import math
+import re
+import struct
+import uuid
+from typing import Any
+
+PAGE_SIZE = 10
+
+# same as default `pg_trgm.word_similarity_threshold`, used by `%>` operator in DB
+SIMILARITY_THRESHOLD = 0.6
+
+# Frecency: every use of a ref adds exp(FRECENCY_RATE * time of use) to it, and score is log of this sum.
+# All scores decay at the same rate, so their order changes only when refs are used, and stored scores are
+# never recalculated. New ref gets score as if it was used once when added
+FRECENCY_HALF_LIFE = 7 * 24 * 60 * 60
+FRECENCY_RATE = math.log(2) / FRECENCY_HALF_LIFE
+
+# score, id
+_OFFSET_STRUCT = struct.Struct('>d16s')
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def like_pattern(filter: str) -> str:
+    # user may use `*` and `?` as wildcards, everything else is matched literally (escape char is `\`)
+    escaped = filter.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped.replace('*', '%').replace('?', '_') + '%'
+
+
+def similarity_text(filter: str) -> str:
+    return filter.replace('*', ' ').replace('?', ' ').strip()
+
+
+def _trigrams(text: str) -> set[str]:
+    # same way as pg_trgm does: lowercase alphanumeric words, padded with two spaces before and one after
+    result = set()
+    for word in _WORD_RE.findall(text.lower()):
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def word_similarity(text: str, name: str) -> float:
+    # simplified `word_similarity()` of pg_trgm: share of text trigrams found in name
+    text_trigrams = _trigrams(text)
+    if not text_trigrams:
+        return 0
+    return len(text_trigrams & _trigrams(name)) / len(text_trigrams)
+
+
+def frecency_point(timestamp: float, count: int = 1) -> float:
+    # score of `count` uses at `timestamp` (unix time)
+    return timestamp * FRECENCY_RATE + math.log(count)
+
+
+def add_frecency(score: float, point: float) -> float:
+    # log(exp(score) + exp(point)) without overflow
+    return max(score, point) + math.log1p(math.exp(-abs(score - point)))
+
+
+def ref_key(ref: dict[str, Any]) -> tuple:
+    # refs are listed by this key descending, same as `score, id` in DB
+    return ref['score'], ref['id']
+
+
+def encode_offset(ref: dict[str, Any]) -> str:
+    # keyset pagination cursor for `next_offset` of inline query answer, must fit in 64 bytes
+    return base64.urlsafe_b64encode(_OFFSET_STRUCT.pack(ref['score'], ref['id'].bytes)).decode()
+
+
+def decode_offset(offset: str) -> dict[str, Any] | None:
+    try:
+        score, ref_id = _OFFSET_STRUCT.unpack(base64.urlsafe_b64decode(offset))
+    except (binascii.Error, struct.error, ValueError):
+        return None
+    return {'score': score, 'id': uuid.UUID(bytes=ref_id)}
+
+
+def paginate_refs(refs: tuple[dict[str, Any], ...], after: dict[str, Any] | None, limit: int) -> list[dict[str, Any]]:
+    if after is None:
+        return list(refs[:limit])
+    after_key = ref_key(after)
+    return [ref for ref in refs if ref_key(ref) < after_key][:limit]
+
+
+def _filter_regex(filter: str) -> re.Pattern:
+    pattern = ''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char) for char in filter)
+    return re.compile(pattern, re.IGNORECASE | re.DOTALL)
+
+
+def filter_refs(refs: tuple[dict[str, Any], ...], filter: str | None, limit: int) -> list[dict[str, Any]]:
+    # in-memory version of `get_refs`: exact matches first, then similar names, ranked by similarity
+    if not filter:
+        return list(refs[:limit])
+    regex = _filter_regex(filter)
+    text = similarity_text(filter)
+    ranked = []
+    for ref in refs:
+        matched = bool(regex.search(ref['ref_name']))
+        score = word_similarity(text, ref['ref_name'])
+        if matched or score >= SIMILARITY_THRESHOLD:
+            ranked.append((not matched, -score, ref))
+    ranked.sort(key=lambda item: item[:2])
+    return [ref for _, _, ref in ranked[:limit]]
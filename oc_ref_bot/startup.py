@@ -0,0 +1,82 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import time
+from collections.abc import Iterator
+
+from aiogram import Bot
+from aiogram.types import BotCommand
+from aiopg.sa import Engine
+
+from oc_ref_bot import VERSION
+from oc_ref_bot.config import settings
+from oc_ref_bot.database import get_meta, set_meta, acquire
+from oc_ref_bot.metrics import Gauge
+
+log = logging.getLogger(__name__)
+
+startup_seconds = Gauge('ocrefbot_startup_seconds', 'Time spent on startup phases')
+
+BOT_COMMANDS = [
+    BotCommand(command='help', description='Справка по командам'),
+    # BotCommand(command='version', description='Текущая версия бота'),
+    BotCommand(command='add', description='Добавление референса'),
+    BotCommand(command='add_many', description='Добавление нескольких референсов сразу'),
+    BotCommand(command='del', description='Удаление референса'),
+    BotCommand(command='csv', description='Выгрузка референсов в CSV'),
+]
+
+_started_at = time.perf_counter()
+_phases: dict[str, float] = {}
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = time.perf_counter() - started_at
+        startup_seconds.set(_phases[name], phase=name)
+
+
+def report() -> None:
+    total = time.perf_counter() - _started_at
+    startup_seconds.set(total, phase='total')
+    log.info(
+        'Started in %.3f s (%s)', total, ', '.join(f'{name} {seconds:.3f} s' for name, seconds in _phases.items()),
+    )
+
+
+async def _set_name(bot: Bot, name: str) -> None:
+    # cached, polling asks for it anyway
+    me = await bot.me()
+    if me.full_name != name:
+        await bot.set_my_name(name)
+
+
+async def setup_bot(bot: Bot, pg: Engine) -> None:
+    # commands and name are changed rarely and setting them is rate limited, so they are set only
+    # when changed since the last successful setup. Changes made via BotFather are not noticed
+    name = f'{settings.bot_name} [{VERSION}]'
+    fingerprint = hashlib.sha256(json.dumps({
+        'commands': [command.model_dump() for command in BOT_COMMANDS],
+        'name': name,
+    }, sort_keys=True).encode()).hexdigest()
+    key = f'bot_setup:{bot.id}'
+    try:
+        with phase('bot setup'):
+            async with acquire(pg) as conn:
+                if await get_meta(conn, key) == fingerprint:
+                    log.info('Bot commands and name are up to date')
+                    return
+            await asyncio.gather(bot.set_my_commands(BOT_COMMANDS), _set_name(bot, name))
+            async with acquire(pg) as conn:
+                await set_meta(conn, key, fingerprint)
+            log.info('Bot commands and name were set')
+    except Exception:
+        log.exception('Bot setup failed')
+    finally:
+        log.info('Bot setup took %.3f s', _phases['bot setup'])
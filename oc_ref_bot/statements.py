@@ -0,0 +1,83 @@
+import re
+import weakref
+from collections.abc import Callable
+from typing import Any
+
+import psycopg2
+from aiopg.sa import SAConnection
+from aiopg.sa.engine import get_dialect
+from aiopg.sa.result import ResultProxy
+from sqlalchemy.sql import ClauseElement
+
+from oc_ref_bot.metrics import Counter
+
+prepared = Counter('ocrefbot_db_statements_prepared_total', 'Statements prepared on connections')
+
+_PARAMETER = re.compile(r'%\((\w+)\)s')
+# the same dialect as engines of aiopg have, its compiler evaluates defaults of columns in `construct_params()`
+_dialect = get_dialect()
+
+
+class Statement:
+    # SQLAlchemy statement compiled to SQL once and run as server side prepared statement, prepared on every
+    # connection at first use. Values are passed to `execute()` by names of bound parameters, so for every call
+    # neither SQLAlchemy compiles the statement, nor Postgres parses and plans it again.
+    # Statements with parameters expanded at execution (like `in_()` with list) are not supported. Values are
+    # processed by their types, but results are as psycopg2 returns them (UUID and JSON are decoded by adapters
+    # aiopg registers), so types with result processing of SQLAlchemy only (like `TypeDecorator`) are not supported
+    def __init__(self, name: str, query: ClauseElement) -> None:
+        self.name = f'ocrefbot_{name}'
+        self.query = query
+        self._compiled = None
+        self._processors: dict[str, Callable[[Any], Any]] = {}
+        self._prepare_sql = ''
+        self._execute_sql = ''
+        self._connections: weakref.WeakSet = weakref.WeakSet()
+
+    def _compile(self) -> None:
+        compiled = self.query.compile(dialect=_dialect)
+        parameters: list[str] = []
+
+        def placeholder(match: re.Match) -> str:
+            if match[1] not in parameters:
+                parameters.append(match[1])
+            return f'${parameters.index(match[1]) + 1}'
+
+        # `%%` are left as is, both statements are formatted by psycopg2
+        self._prepare_sql = f'PREPARE {self.name} AS {_PARAMETER.sub(placeholder, str(compiled))}'
+        arguments = ', '.join(f'%({parameter})s' for parameter in parameters)
+        self._execute_sql = f'EXECUTE {self.name}({arguments})' if parameters else f'EXECUTE {self.name}'
+        self._processors = {
+            parameter: processor for parameter in parameters
+            if (processor := compiled.binds[parameter].type.bind_processor(_dialect)) is not None
+        }
+        self._compiled = compiled
+
+    async def execute(self, conn: SAConnection, **values: Any) -> ResultProxy:
+        if self._compiled is None:
+            self._compile()
+        # the same as aiopg does for statements compiled on every call: defaults (like generated ids) and type
+        # processing of values
+        processors = self._processors
+        parameters = {
+            key: processors[key](value) if key in processors else value
+            for key, value in self._compiled.construct_params(values).items()
+        }
+        # prepared statements live until connection is closed, even if transaction is rolled back
+        if conn.connection not in self._connections:
+            await self._prepare(conn)
+        try:
+            return await conn.execute(self._execute_sql, parameters)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # deallocated by someone else (`DEALLOCATE`, `DISCARD ALL`). Failed transaction can't be continued,
+            # statement will be prepared again by next call
+            self._connections.discard(conn.connection)
+            if conn.in_transaction:
+                raise
+        await self._prepare(conn)
+        return await conn.execute(self._execute_sql, parameters)
+
+    async def _prepare(self, conn: SAConnection) -> None:
+        await conn.execute(self._prepare_sql, {})
+        self._connections.add(conn.connection)
+        prepared.inc(statement=self.name)
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from oc_ref_bot.config import settings
+
+log = logging.getLogger(__name__)
+
+
+async def start_webhook(dp: Dispatcher, bot: Bot) -> None:
+    app = web.Application()
+    # updates are handled while Telegram waits for response, so methods returned
+    # by handlers (like inline query answers) are sent right in the webhook response
+    SimpleRequestHandler(
+        dp, bot, handle_in_background=False, secret_token=settings.webhook_secret,
+    ).register(app, path=settings.webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, settings.webhook_host, settings.webhook_port).start()
+        log.info('Webhook server listening on %s:%s', settings.webhook_host, settings.webhook_port)
+        if settings.webhook_url:
+            await bot.set_webhook(
+                f'{str(settings.webhook_url).rstrip("/")}{settings.webhook_path}',
+                secret_token=settings.webhook_secret,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            log.info('Webhook was set')
+        else:
+            log.warning('Webhook url is not set, waiting for updates posted locally')
+
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+        await stopping.wait()
+        log.info('Stopping webhook server')
+    finally:
+        # waits for updates being handled, then runs dispatcher shutdown and closes bot session
+        await runner.cleanup()
@@ -0,0 +1,131 @@
+import abc
+import asyncio
+import contextlib
+import logging
+import time
+import uuid
+from typing import Any, Self
+
+from aiogram.types import User
+from aiopg.sa import Engine, SAConnection
+
+from oc_ref_bot.database import save_users, save_refs_usage, acquire
+
+log = logging.getLogger(__name__)
+
+
+# Collects writes in memory, merging them by key, and flushes them into DB with one query
+# when buffer reaches `max_size`, every `interval` seconds and on exit
+class WriteBehindBuffer(abc.ABC):
+    def __init__(self, pg: Engine, max_size: int, interval: float) -> None:
+        self.pg = pg
+        self.max_size = max_size
+        self.interval = interval
+        self.flushed = 0
+        self._pending: dict[Any, Any] = {}
+        # keys of items being written by flushes, so flushes of these keys wait until they are in DB
+        self._writing: dict[Any, asyncio.Future] = {}
+        self._flush_needed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def __aenter__(self) -> Self:
+        self._task = asyncio.create_task(self._flush_loop())
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        await self.flush()
+
+    def _put(self, key: Any, value: Any) -> None:
+        if key in self._pending:
+            value = self._merge(self._pending[key], value)
+        self._pending[key] = value
+        if len(self._pending) >= self.max_size:
+            self._flush_needed.set()
+
+    @abc.abstractmethod
+    def _merge(self, old: Any, new: Any) -> Any:
+        pass
+
+    @abc.abstractmethod
+    async def _write(self, conn: SAConnection, items: dict[Any, Any]) -> None:
+        pass
+
+    async def _flush_loop(self) -> None:
+        while True:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._flush_needed.wait(), self.interval)
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('%s flush failed', type(self).__name__)
+
+    async def flush(self, *keys: Any, conn: SAConnection | None = None) -> None:
+        if keys:
+            # items which failed to be written are returned to buffer and taken from there
+            while writing := {self._writing[key] for key in keys if key in self._writing}:
+                await asyncio.wait(writing)
+            items = {key: self._pending.pop(key) for key in keys if key in self._pending}
+        else:
+            items, self._pending = self._pending, {}
+        if not items:
+            return
+        written = asyncio.get_running_loop().create_future()
+        self._writing.update(dict.fromkeys(items, written))
+        try:
+            if conn is None:
+                async with acquire(self.pg) as own_conn:
+                    await self._write(own_conn, items)
+            else:
+                await self._write(conn, items)
+        except Exception:
+            # return items back to buffer, so they will be written with next flush
+            for key, value in items.items():
+                self._put(key, value)
+            raise
+        finally:
+            for key in items:
+                if self._writing.get(key) is written:
+                    del self._writing[key]
+            written.set_result(None)
+        self.flushed += len(items)
+        log.debug('%s flushed %s items', type(self).__name__, len(items))
+
+
+class UsersBuffer(WriteBehindBuffer):
+    def add(self, user: User) -> None:
+        self._put(user.id, {
+            'id': user.id,
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'is_premium': user.is_premium,
+            'language_code': user.language_code,
+            'messages_count': 1,
+        })
+
+    def _merge(self, old: dict, new: dict) -> dict:
+        return new | {'messages_count': old['messages_count'] + new['messages_count']}
+
+    async def _write(self, conn: SAConnection, items: dict[int, dict]) -> None:
+        # sorted to lock rows in the same order in concurrent flushes
+        await save_users(conn, [items[user_id] for user_id in sorted(items)])
+
+
+class UsageBuffer(WriteBehindBuffer):
+    def add(self, ref_id: uuid.UUID) -> None:
+        self._put(ref_id, (1, time.monotonic()))
+
+    def _merge(self, old: tuple[int, float], new: tuple[int, float]) -> tuple[int, float]:
+        return old[0] + new[0], max(old[1], new[1])
+
+    async def _write(self, conn: SAConnection, items: dict[uuid.UUID, tuple[int, float]]) -> None:
+        now = time.monotonic()
+        usage = [(ref_id, count, now - sent_at) for ref_id, (count, sent_at) in sorted(items.items())]
+        await save_refs_usage(conn, usage)
@@ -0,0 +1,11 @@
+import os
+
+# settings required by the bot, but not used by tests. Database is the same as of benchmarks:
+#   DB_HOST=localhost DB_USER=bench DB_PASS=bench DB_DB=bench python -m pytest
+os.environ.setdefault('BOT_TOKEN', '123456:' + 'x' * 35)
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('SENTRY_DSN', 'https://public@localhost/1')
+os.environ.setdefault('DB_HOST', 'localhost')
+os.environ.setdefault('DB_USER', 'bench')
+os.environ.setdefault('DB_PASS', 'bench')
+os.environ.setdefault('DB_DB', 'bench')
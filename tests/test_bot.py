@@ -0,0 +1,63 @@
+import asyncio
+import contextlib
+
+from aiogram import Bot
+from aiogram.types import Update
+
+from oc_ref_bot.blocklist import Blocklist
+from oc_ref_bot.bot import BotDispatcher
+from oc_ref_bot.config import settings
+from oc_ref_bot.fsm_storage import PgStorage
+
+BLOCKED_USER_ID = 42
+
+
+class Engine:
+    # engine without database, counts connections which queries take
+    def __init__(self) -> None:
+        self.acquired = 0
+
+    async def acquire(self) -> None:
+        self.acquired += 1
+        raise ConnectionError('No database in tests')
+
+
+def message(user_id: int) -> Update:
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+    return Update.model_validate({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'from': user, 'text': 'Fox',
+    }})
+
+
+def inline_query(user_id: int) -> Update:
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+    return Update.model_validate({'update_id': 1, 'inline_query': {
+        'id': '1', 'from': user, 'query': 'Fox', 'offset': '',
+    }})
+
+
+def feed(update: Update) -> Engine:
+    async def main() -> None:
+        blocklist = Blocklist(pg)
+        blocklist.users.add(BLOCKED_USER_ID)
+        dp = BotDispatcher(storage=PgStorage(pg, 10, 60, 60), blocklist=blocklist, pg=pg)
+        async with Bot(settings.bot_token) as bot:
+            with contextlib.suppress(ConnectionError):
+                await dp.feed_update(bot, update)
+
+    pg = Engine()
+    asyncio.run(main())
+    return pg
+
+
+def test_blocked_user_costs_no_query() -> None:
+    assert feed(message(BLOCKED_USER_ID)).acquired == 0
+
+
+def test_user_state_is_read() -> None:
+    # the same update of user who isn't blocked reads FSM state first
+    assert feed(message(BLOCKED_USER_ID + 1)).acquired == 1
+
+
+def test_inline_query_reads_no_state() -> None:
+    assert feed(inline_query(BLOCKED_USER_ID + 1)).acquired == 0
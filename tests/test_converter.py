@@ -0,0 +1,32 @@
+import io
+
+import pytest
+from PIL import Image
+
+from oc_ref_bot.converter import FileTooLargeError, _downscale
+
+
+def jpeg(width: int, height: int) -> io.BytesIO:
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'red').save(buffer, 'JPEG')
+    buffer.seek(0)
+    return buffer
+
+
+def test_small_image_kept() -> None:
+    buffer = jpeg(100, 50)
+    assert _downscale(buffer, 200, 10_000) == buffer.getvalue()
+
+
+def test_large_image_downscaled() -> None:
+    with Image.open(io.BytesIO(_downscale(jpeg(400, 200), 100, 100_000))) as image:
+        assert image.size == (100, 50)
+
+
+def test_not_image_kept() -> None:
+    assert _downscale(io.BytesIO(b'not an image'), 100, 10_000) == b'not an image'
+
+
+def test_too_many_pixels() -> None:
+    with pytest.raises(FileTooLargeError):
+        _downscale(jpeg(400, 200), 100, 10_000)
@@ -0,0 +1,57 @@
+import uuid
+
+from oc_ref_bot.ref_cache import RefCache, RecentWrites, RefsChanges
+
+
+def ref(user_id: int) -> dict:
+    return {'id': uuid.uuid4(), 'user_id': user_id, 'used_count': 0, 'score': 0.0, 'used_at': None}
+
+
+def test_change_of_other_user_keeps_load() -> None:
+    cache = RefCache(max_users=10, max_refs=10, ttl=60)
+    generation = cache.generation(1)
+    cache.invalidate(2)
+    cache.ref_used(2, uuid.uuid4())
+    cache.put(1, [ref(1)], generation)
+    assert cache.get(1) is not None
+
+
+def test_change_of_user_drops_load() -> None:
+    cache = RefCache(max_users=10, max_refs=10, ttl=60)
+    generation = cache.generation(1)
+    cache.invalidate(1)
+    cache.put(1, [ref(1)], generation)
+    assert cache.get(1) is None
+    # loaded after the change
+    cache.put(1, [ref(1)], cache.generation(1))
+    assert cache.get(1) is not None
+
+
+def test_forgotten_change_drops_load() -> None:
+    cache = RefCache(max_users=1, max_refs=10, ttl=60)
+    generation = cache.generation(1)
+    cache.invalidate(1)
+    # change of user 1 is forgotten
+    cache.invalidate(2)
+    cache.put(1, [ref(1)], generation)
+    assert cache.get(1) is None
+
+
+def test_notification_drops_user() -> None:
+    cache, writes = RefCache(max_users=10, max_refs=10, ttl=60), RecentWrites(window=60)
+    for user_id in (1, 2):
+        cache.put(user_id, [ref(user_id)], cache.generation(user_id))
+    RefsChanges(cache, writes).on_notify('1')
+    assert cache.get(1) is None
+    assert cache.get(2) is not None
+    assert 1 in writes
+
+
+def test_reconnect_drops_loads() -> None:
+    cache = RefCache(max_users=10, max_refs=10, ttl=60)
+    cache.put(1, [ref(1)], cache.generation(1))
+    generation = cache.generation(2)
+    RefsChanges(cache, RecentWrites(window=60)).on_reconnect()
+    cache.put(2, [ref(2)], generation)
+    assert cache.get(1) is None
+    assert cache.get(2) is None
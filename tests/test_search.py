@@ -0,0 +1,79 @@
+import re
+import uuid
+
+import pytest
+
+from oc_ref_bot.search import (
+    like_pattern, similarity_text, word_similarity, filter_refs, encode_offset, decode_offset, paginate_refs, ref_key,
+)
+
+# limit of `next_offset` of inline query answer
+MAX_OFFSET_LENGTH = 64
+
+
+def like_match(pattern: str, text: str) -> bool:
+    # `ILIKE` with `\` as escape char, as `get_refs` runs it
+    regex = re.sub(r'\\(.)|(%)|(_)|(.)', lambda m: (
+        re.escape(m[1]) if m[1] is not None else '.*' if m[2] else '.' if m[3] else re.escape(m[4])
+    ), pattern, flags=re.DOTALL)
+    return re.fullmatch(regex, text, re.IGNORECASE | re.DOTALL) is not None
+
+
+def ref(name: str, score: float = 0.0) -> dict:
+    return {'id': uuid.uuid4(), 'ref_name': name, 'score': score}
+
+
+@pytest.mark.parametrize(('filter', 'name', 'matched'), [
+    ('100%', 'Sale 100% off', True),
+    ('100%', 'Sale 1000 off', False),
+    ('a_b', 'x a_b y', True),
+    ('a_b', 'x acb y', False),
+    ('back\\slash', 'with back\\slash', True),
+    ('back\\slash', 'with backslash', False),
+    ('ca*t', 'Cabinet', True),
+    ('c?t', 'CAT', True),
+    ('c?t', 'coat', False),
+])
+def test_like_pattern(filter: str, name: str, matched: bool) -> None:  # noqa: FBT001 - arguments of pytest
+    assert like_match(like_pattern(filter), name) is matched
+
+
+def test_similarity_text_drops_wildcards() -> None:
+    assert similarity_text(' fox*tail? ') == 'fox tail'
+
+
+def test_word_similarity() -> None:
+    assert word_similarity('fox', 'Red Fox') == 1
+    assert 0 < word_similarity('foks', 'Red Fox') < 1
+    assert word_similarity('', 'Red Fox') == 0
+
+
+def test_filter_refs_ranks_matches_first() -> None:
+    refs = tuple(ref(name) for name in ('Foxy', 'Wolf', 'Red fox', 'Fix'))
+    assert [r['ref_name'] for r in filter_refs(refs, 'fox', 10)] == ['Red fox', 'Foxy']
+    # typo: no exact match, only names similar enough
+    assert [r['ref_name'] for r in filter_refs(refs, 'red foxx', 10)] == ['Red fox']
+    assert [r['ref_name'] for r in filter_refs(refs, None, 2)] == ['Foxy', 'Wolf']
+
+
+def test_offset_round_trip() -> None:
+    after = ref('Fox', 12345.678)
+    offset = encode_offset(after)
+    assert len(offset.encode()) <= MAX_OFFSET_LENGTH
+    assert decode_offset(offset) == {'score': after['score'], 'id': after['id']}
+
+
+@pytest.mark.parametrize('offset', ['', 'garbage', '!!!', encode_offset(ref('Fox'))[:-4]])
+def test_bad_offset(offset: str) -> None:
+    assert decode_offset(offset) is None
+
+
+def test_paginate_refs() -> None:
+    refs = tuple(sorted((ref(f'Ref {i}', i // 2) for i in range(7)), key=ref_key, reverse=True))
+    pages, after = [], None
+    while page := paginate_refs(refs, after, 3):
+        pages.append(page)
+        after = decode_offset(encode_offset(page[-1]))
+    # pages continue after the last ref, also between refs with equal scores
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [r for page in pages for r in page] == list(refs)
@@ -0,0 +1,163 @@
+import asyncio
+import uuid
+from collections.abc import Awaitable, Callable
+
+import psycopg2
+import pytest
+import sqlalchemy as sa
+from aiopg.sa import SAConnection
+
+from oc_ref_bot import database
+from oc_ref_bot.config import settings
+from oc_ref_bot.database import tbl_refs, tbl_users
+from oc_ref_bot.statements import Statement
+
+# users of benchmarks start from 2_000_000_000
+USER_ID = 1_999_999_999
+
+try:
+    psycopg2.connect(
+        host=settings.db_host, port=settings.db_port, user=settings.db_user, password=settings.db_pass,
+        dbname=settings.db_db, connect_timeout=3,
+    ).close()
+except psycopg2.OperationalError as e:
+    pytest.skip(f'Postgres is not available: {e}', allow_module_level=True)
+
+
+def run(test: Callable[[SAConnection], Awaitable[None]]) -> None:
+    # every test has its own engine, so statements are not prepared on its connections yet.
+    # Data is added in transaction, which is rolled back
+    async def main() -> None:
+        async with database.db_engine() as pg, database.acquire(pg) as conn:
+            await database.ensure_schema(conn)
+            await test(conn)
+
+    asyncio.run(main())
+
+
+async def add_user(conn: SAConnection) -> None:
+    await conn.execute(sa.insert(tbl_users).values(id=USER_ID))
+
+
+async def add_ref(conn: SAConnection, ref_name: str) -> dict:
+    ref = {
+        'ref_name': ref_name, 'doc_file_id': None, 'photo_file_id': f'photo_{ref_name}', 'doc_file_unique_id': None,
+        'photo_file_unique_id': f'unique_{ref_name}',
+    }
+    return dict(await database.add_ref(conn, USER_ID, ref))
+
+
+def increment(name: str) -> Statement:
+    # types of parameters are inferred by Postgres on preparing, so they are cast where it can't do it
+    return Statement(name, sa.select(sa.cast(sa.bindparam('value'), sa.INTEGER) + 1))
+
+
+async def prepared_count(conn: SAConnection, statement: Statement) -> int:
+    return await conn.scalar(
+        sa.text('SELECT count(*) FROM pg_prepared_statements WHERE name = :name'), {'name': statement.name},
+    )
+
+
+def test_rows_match_query() -> None:
+    async def test(conn: SAConnection) -> None:
+        async with conn.begin() as transaction:
+            await add_user(conn)
+            ref_names = ('one', 'two')
+            for ref_name in ref_names:
+                await add_ref(conn, ref_name)
+            statement = Statement('test_rows', database._user_refs_query())
+            values = {'user_id': USER_ID, 'limit': 10}
+            rows = await (await statement.execute(conn, **values)).fetchall()
+            expected = await (await conn.execute(statement.query, values)).fetchall()
+            assert [dict(row) for row in rows] == [dict(row) for row in expected]
+            assert len(rows) == len(ref_names)
+            # UUID columns are decoded the same as by compiled query
+            assert isinstance(rows[0].id, uuid.UUID)
+            await transaction.rollback()
+
+    run(test)
+
+
+def test_expression_results_decoded() -> None:
+    async def test(conn: SAConnection) -> None:
+        ref_id = uuid.uuid4()
+        statement = Statement('test_decoded', sa.select(
+            sa.cast(sa.bindparam('ref_id', type_=sa.TEXT), tbl_refs.c.id.type).label('ref_id'),
+        ))
+        assert await (await statement.execute(conn, ref_id=str(ref_id))).scalar() == ref_id
+
+    run(test)
+
+
+def test_insert_evaluates_defaults() -> None:
+    async def test(conn: SAConnection) -> None:
+        async with conn.begin() as transaction:
+            await add_user(conn)
+            first, second = await add_ref(conn, 'one'), await add_ref(conn, 'two')
+            assert isinstance(first['id'], uuid.UUID)
+            assert first['id'] != second['id']
+            assert first['used_count'] == 0
+            await transaction.rollback()
+
+    run(test)
+
+
+def test_prepared_once_per_connection() -> None:
+    async def test(conn: SAConnection) -> None:
+        statement = increment('test_once')
+        for value in range(3):
+            assert await (await statement.execute(conn, value=value)).scalar() == value + 1
+        assert await prepared_count(conn, statement) == 1
+
+    run(test)
+
+
+def test_prepared_again_after_deallocate() -> None:
+    async def test(conn: SAConnection) -> None:
+        statement = increment('test_deallocate')
+        await statement.execute(conn, value=1)
+        await conn.execute(f'DEALLOCATE {statement.name}')
+        assert await (await statement.execute(conn, value=1)).scalar() == 1 + 1
+        assert await prepared_count(conn, statement) == 1
+
+    run(test)
+
+
+def test_deallocated_in_transaction() -> None:
+    async def test(conn: SAConnection) -> None:
+        statement = increment('test_deallocate_transaction')
+        await statement.execute(conn, value=1)
+        await conn.execute('DISCARD ALL')
+        async with conn.begin() as transaction:
+            # transaction is failed, so it's not retried
+            with pytest.raises(psycopg2.errors.InvalidSqlStatementName):
+                await statement.execute(conn, value=1)
+            await transaction.rollback()
+        assert await (await statement.execute(conn, value=1)).scalar() == 1 + 1
+
+    run(test)
+
+
+def test_prepared_statement_survives_rollback() -> None:
+    async def test(conn: SAConnection) -> None:
+        statement = increment('test_rollback')
+        async with conn.begin() as transaction:
+            await statement.execute(conn, value=1)
+            await transaction.rollback()
+        assert await (await statement.execute(conn, value=1)).scalar() == 1 + 1
+
+    run(test)
+
+
+def test_percent_operators() -> None:
+    # `%>` is escaped as `%%>` in compiled statement
+    async def test(conn: SAConnection) -> None:
+        async with conn.begin() as transaction:
+            await add_user(conn)
+            for ref_name in ('apple pie', 'banana'):
+                await add_ref(conn, ref_name)
+            refs = await database.get_refs(conn, USER_ID, 'aple')
+            assert [ref.ref_name for ref in refs] == ['apple pie']
+            await transaction.rollback()
+
+    run(test)
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Any
+
+from oc_ref_bot.write_behind import WriteBehindBuffer
+
+
+class Buffer(WriteBehindBuffer):
+    # writes items of `slow` connection when released, fails them if `fail` is set
+    def __init__(self) -> None:
+        super().__init__(None, max_size=100, interval=60)
+        self.written: list[tuple[str, dict]] = []
+        self.release = asyncio.Event()
+        self.fail = False
+
+    def _merge(self, old: Any, new: Any) -> Any:
+        return new
+
+    async def _write(self, conn: str, items: dict) -> None:
+        if conn == 'slow':
+            await self.release.wait()
+            if self.fail:
+                raise RuntimeError
+        self.written.append((conn, items))
+
+
+async def flush_while_writing(buffer: Buffer) -> None:
+    buffer._put(1, 'one')
+    buffer._put(2, 'two')
+    slow = asyncio.create_task(buffer.flush(conn='slow'))
+    await asyncio.sleep(0)
+    keyed = asyncio.create_task(buffer.flush(1, conn='fast'))
+    await asyncio.sleep(0.01)
+    assert not keyed.done()
+    buffer.release.set()
+    await asyncio.gather(slow, keyed, return_exceptions=True)
+
+
+def test_keyed_flush_waits_for_write() -> None:
+    async def test() -> None:
+        buffer = Buffer()
+        await flush_while_writing(buffer)
+        assert buffer.written == [('slow', {1: 'one', 2: 'two'})]
+
+    asyncio.run(test())
+
+
+def test_keyed_flush_writes_failed_items() -> None:
+    async def test() -> None:
+        buffer = Buffer()
+        buffer.fail = True
+        await flush_while_writing(buffer)
+        assert buffer.written == [('fast', {1: 'one'})]
+        assert len(buffer) == 1
+
+    asyncio.run(test())